@@ -1,14 +1,540 @@
 import os
+import sys
+import hashlib
+import hmac
 import json
+import math
+import itertools
+import random
+import socket
+import time
+import threading
+from collections import Counter, OrderedDict, defaultdict, deque
 import datetime as dt
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g
 from flask_cors import CORS
-from openai import OpenAI
 
 app = Flask(__name__)
 CORS(app)
 
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# ----------------------------
+# Per-client rate limiting (token buckets)
+# ----------------------------
+# "burst:per_minute", override with RATE_LIMIT_ANALYZE / RATE_LIMIT_CHAT.
+def _rate_rule(name, default):
+    raw = os.environ.get(f"RATE_LIMIT_{name.upper()}", default)
+    burst, _, per_minute = raw.partition(":")
+    return int(burst), float(per_minute or burst) / 60.0
+
+RATE_LIMITS = {
+    "/analyze": _rate_rule("analyze", "5:6"),
+    "/chat": _rate_rule("chat", "10:20"),
+}
+RATE_LIMIT_KEY = os.environ.get("RATE_LIMIT_KEY", "ip")  # or "device" (X-Device-Token)
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "50000"))
+RATE_LIMIT_IDLE_SECS = float(os.environ.get("RATE_LIMIT_IDLE_SECS", "600"))
+
+# (path, client) -> [tokens, last_seen], least recently used first.
+_buckets = OrderedDict()
+_buckets_lock = threading.Lock()
+
+def _client_key():
+    if RATE_LIMIT_KEY == "device" and request.headers.get("X-Device-Token"):
+        return "d:" + request.headers["X-Device-Token"][:128]
+    xff = request.headers.get("X-Forwarded-For")
+    return "ip:" + (xff.split(",", 1)[0].strip() if xff else (request.remote_addr or "unknown"))
+
+@app.before_request
+def rate_limit():
+    rule = RATE_LIMITS.get(request.path)
+    if rule is None or request.method == "OPTIONS":
+        return None
+    burst, rate = rule
+    now = time.monotonic()
+    key = (request.path, _client_key())
+    with _buckets_lock:
+        b = _buckets.get(key)
+        if b is None:
+            b = _buckets[key] = [float(burst), now]
+            while len(_buckets) > RATE_LIMIT_MAX_KEYS:
+                _buckets.popitem(last=False)
+            while _buckets and now - next(iter(_buckets.values()))[1] >= RATE_LIMIT_IDLE_SECS:
+                _buckets.popitem(last=False)
+        else:
+            _buckets.move_to_end(key)
+            b[0] = min(float(burst), b[0] + (now - b[1]) * rate)
+            b[1] = now
+        allowed = b[0] >= 1.0
+        if allowed:
+            b[0] -= 1.0
+        tokens = b[0]
+    g.rate_headers = {
+        "RateLimit-Limit": str(burst),
+        "RateLimit-Remaining": str(int(tokens)),
+        "RateLimit-Reset": str(math.ceil((burst - tokens) / rate)),
+        "RateLimit-Policy": f"{burst};w={math.ceil(burst / rate)}",
+    }
+    if not allowed:
+        resp = jsonify(error="Too many requests. Please wait a moment and try again.")
+        resp.headers["Retry-After"] = str(math.ceil((1.0 - tokens) / rate))
+        return resp, 429
+    return None
+
+@app.after_request
+def add_rate_headers(resp):
+    for k, v in getattr(g, "rate_headers", {}).items():
+        resp.headers[k] = v
+    return resp
+
+# Max size of the image data URL, and of the whole request body. Werkzeug
+# enforces MAX_CONTENT_LENGTH while reading the stream: a Content-Length over it
+# is rejected before anything is read, a chunked body as soon as it passes it.
+MAX_B64_CHARS = int(os.environ.get("MAX_B64_CHARS", "6000000"))
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("MAX_BODY_BYTES", str(MAX_B64_CHARS + 64 * 1024)))
+
+# Per-process ceiling on image bytes held by in-flight /analyze requests. New
+# uploads wait up to INFLIGHT_WAIT_SECS for room, then get a 503.
+MAX_INFLIGHT_IMAGE_BYTES = int(os.environ.get("MAX_INFLIGHT_IMAGE_BYTES", str(4 * app.config["MAX_CONTENT_LENGTH"])))
+INFLIGHT_WAIT_SECS = float(os.environ.get("INFLIGHT_WAIT_SECS", "10"))
+
+_inflight_bytes = 0
+_inflight_cond = threading.Condition()
+
+@app.errorhandler(413)
+def too_large(_e):
+    return jsonify(error="Request too large. Please use a smaller screenshot (we will compress on device)."), 413
+
+@app.before_request
+def reserve_image_budget():
+    global _inflight_bytes
+    if request.path != "/analyze" or request.method != "POST":
+        return None
+    n = request.content_length or app.config["MAX_CONTENT_LENGTH"]
+    if n > app.config["MAX_CONTENT_LENGTH"]:
+        return too_large(None)
+    with _inflight_cond:
+        if not _inflight_cond.wait_for(lambda: _inflight_bytes + n <= MAX_INFLIGHT_IMAGE_BYTES, timeout=INFLIGHT_WAIT_SECS):
+            resp = jsonify(error="Server is busy processing other images. Please retry shortly.")
+            resp.headers["Retry-After"] = str(max(1, int(INFLIGHT_WAIT_SECS)))
+            return resp, 503
+        _inflight_bytes += n
+    request.environ["waspada.reserved_bytes"] = n
+    return None
+
+@app.teardown_request
+def release_image_budget(_exc):
+    global _inflight_bytes
+    n = request.environ.pop("waspada.reserved_bytes", 0)
+    if n:
+        with _inflight_cond:
+            _inflight_bytes -= n
+            _inflight_cond.notify_all()
+
+# ----------------------------
+# On-demand request profiling
+# ----------------------------
+# Send `X-Profile: 1` + `X-Admin-Token: $ADMIN_TOKEN`, or set PROFILE_SAMPLE_PCT.
+# A sampler thread snapshots the request thread's stack every
+# PROFILE_INTERVAL_MS and keeps folded stacks (flamegraph.pl / speedscope).
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+PROFILE_SAMPLE_PCT = float(os.environ.get("PROFILE_SAMPLE_PCT", "0"))
+PROFILE_INTERVAL_S = float(os.environ.get("PROFILE_INTERVAL_MS", "5")) / 1000.0
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "")
+_profiles = deque(maxlen=int(os.environ.get("PROFILE_KEEP", "20")))
+_profile_ids = itertools.count(1)
+
+def is_admin():
+    token = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token, ADMIN_TOKEN)
+
+def _sample(prof, ident, stop):
+    while not stop.wait(PROFILE_INTERVAL_S):
+        f = sys._current_frames().get(ident)
+        parts = []
+        while f is not None and len(parts) < 128:
+            parts.append(f"{f.f_globals.get('__name__', '?')}:{f.f_code.co_name}")
+            f = f.f_back
+        if parts:
+            prof["samples"][";".join(reversed(parts))] += 1
+
+@app.before_request
+def start_profile():
+    if request.path.startswith("/debug/"):
+        return None
+    if request.headers.get("X-Profile") == "1" and is_admin():
+        reason = "header"
+    elif PROFILE_SAMPLE_PCT and random.random() * 100 < PROFILE_SAMPLE_PCT:
+        reason = "sample"
+    else:
+        return None
+    prof = {
+        "id": f"{int(time.time())}-{os.getpid()}-{next(_profile_ids)}",
+        "method": request.method,
+        "path": request.path,
+        "reason": reason,
+        "started": time.time(),
+        "interval_ms": PROFILE_INTERVAL_S * 1000,
+        "samples": Counter(),
+    }
+    stop = threading.Event()
+    t = threading.Thread(target=_sample, args=(prof, threading.get_ident(), stop), daemon=True)
+    g.profile = (prof, stop, t, time.perf_counter())
+    t.start()
+    return None
+
+@app.after_request
+def tag_profile(resp):
+    if "profile" in g:
+        g.profile[0]["status"] = resp.status_code
+        resp.headers["X-Profile-Id"] = g.profile[0]["id"]
+    return resp
+
+@app.teardown_request
+def finish_profile(_exc):
+    if "profile" not in g:
+        return
+    prof, stop, t, t0 = g.pop("profile")
+    stop.set()
+    t.join()
+    prof["duration_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+    prof["folded"] = "".join(f"{k} {n}\n" for k, n in prof.pop("samples").most_common())
+    _profiles.append(prof)
+    if PROFILE_DIR:
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            with open(os.path.join(PROFILE_DIR, prof["id"] + ".folded"), "w", encoding="utf-8") as f:
+                f.write(prof["folded"])
+        except OSError:
+            pass
+
+@app.get("/debug/profiles")
+def list_profiles():
+    if not is_admin():
+        return jsonify(error="Not found"), 404
+    return jsonify(result=[{k: v for k, v in p.items() if k != "folded"} for p in reversed(_profiles)]), 200
+
+@app.get("/debug/profiles/<pid>")
+def get_profile(pid):
+    if not is_admin():
+        return jsonify(error="Not found"), 404
+    for p in _profiles:
+        if p["id"] == pid:
+            return Response(p["folded"], mimetype="text/plain")
+    return jsonify(error="Profile not found"), 404
+
+# ----------------------------
+# Idempotency-Key (retried /analyze and /chat)
+# ----------------------------
+# The first request with a key runs and its response is kept for
+# IDEMPOTENCY_TTL_SECS; retries with the same key and body get it replayed
+# (Idempotent-Replayed: true), or wait for it while it's still running. Same key,
+# different body: 422. Keys are scoped per client and path; 5xx isn't kept.
+IDEMPOTENT_PATHS = {"/analyze", "/chat"}
+IDEMPOTENCY_TTL_SECS = float(os.environ.get("IDEMPOTENCY_TTL_SECS", "3600"))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get("IDEMPOTENCY_MAX_KEYS", "10000"))
+IDEMPOTENCY_WAIT_SECS = float(os.environ.get("IDEMPOTENCY_WAIT_SECS", "120"))
+
+# (path, client, key) -> entry, oldest first.
+_idem = OrderedDict()
+_idem_lock = threading.Lock()
+
+@app.before_request
+def check_idempotency():
+    key = request.headers.get("Idempotency-Key")
+    if key is None or request.path not in IDEMPOTENT_PATHS or request.method != "POST":
+        return None
+    if not key or len(key) > 255:
+        return jsonify(error="Idempotency-Key must be 1-255 characters"), 400
+    fp = hashlib.sha256(request.get_data()).hexdigest()  # cached for get_json()
+    k = (request.path, _client_key(), key)
+    while True:
+        now = time.monotonic()
+        with _idem_lock:
+            e = _idem.get(k)
+            if e is not None and e["expires"] <= now:
+                del _idem[k]
+                e = None
+            if e is None:
+                e = _idem[k] = {"fp": fp, "done": threading.Event(), "resp": None, "usage": [0, 0], "waiters": 0, "expires": float("inf")}
+                while len(_idem) > IDEMPOTENCY_MAX_KEYS:
+                    _idem.popitem(last=False)
+                while _idem and next(iter(_idem.values()))["expires"] <= now:
+                    _idem.popitem(last=False)
+                g.idem = (k, e)
+                return None
+        if e["fp"] != fp:
+            count("idempotency.mismatched")
+            return jsonify(error="Idempotency-Key was already used with a different request body"), 422
+        if not e["done"].is_set():
+            count("idempotency.waited")
+            # While we wait, the first request keeps going even if its own
+            # client has left (see client_gone()).
+            with _idem_lock:
+                e["waiters"] += 1
+            try:
+                deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECS
+                while not e["done"].wait(1.0):
+                    if client_gone():
+                        count("idempotency.abandoned")
+                        return "", CLIENT_CLOSED
+                    if time.monotonic() >= deadline:
+                        resp = jsonify(error="A request with this Idempotency-Key is still in progress")
+                        resp.headers["Retry-After"] = "5"
+                        return resp, 409
+            finally:
+                with _idem_lock:
+                    e["waiters"] -= 1
+        if e["resp"] is not None:
+            status, headers, body = e["resp"]
+            count("idempotency.replayed")
+            count("idempotency.saved_prompt_tokens", e["usage"][0])
+            count("idempotency.saved_completion_tokens", e["usage"][1])
+            resp = Response(body, status=status, headers=headers)
+            resp.headers["Idempotent-Replayed"] = "true"
+            return resp
+        # The first attempt failed and wasn't kept: run this one.
+
+def note_usage(prompt_tokens, completion_tokens):
+    # Upstream tokens behind the response being built, for the replay counters.
+    if "idem" in g:
+        u = g.idem[1]["usage"]
+        u[0] += prompt_tokens
+        u[1] += completion_tokens
+
+def _finish_idempotent(resp):
+    k, e = g.pop("idem")
+    with _idem_lock:
+        if resp is not None:
+            e["resp"] = resp
+            e["expires"] = time.monotonic() + IDEMPOTENCY_TTL_SECS
+            _idem.pop(k, None)
+            _idem[k] = e  # back of the queue, so the front stays in expiry order
+        elif _idem.get(k) is e:
+            del _idem[k]
+    e["done"].set()
+
+@app.after_request
+def store_idempotent(resp):
+    if "idem" in g:
+        keep = resp.status_code < 500 and resp.status_code != CLIENT_CLOSED and not resp.direct_passthrough
+        _finish_idempotent((resp.status_code, list(resp.headers), resp.get_data()) if keep else None)
+        if keep:
+            count("idempotency.stored")
+    return resp
+
+@app.teardown_request
+def drop_idempotent(_exc):
+    if "idem" in g:
+        _finish_idempotent(None)
+
+# ----------------------------
+# Client disconnects
+# ----------------------------
+# Upstream calls stream, and every CANCEL_CHECK_SECS the worker peeks at the
+# client socket; once it reads EOF the stream is closed, generation stops
+# upstream and the worker is free for the next request. Needs gunicorn (it puts
+# the socket in the environ); under the dev server nothing is cancelled.
+CANCEL_CHECK_SECS = float(os.environ.get("CANCEL_CHECK_SECS", "0.25"))
+CLIENT_CLOSED = 499  # nginx's "client closed request"; nobody receives it
+
+class ClientGone(Exception):
+    pass
+
+def client_gone():
+    sock = request.environ.get("gunicorn.socket")
+    if sock is None:
+        return False
+    # Still waiting on us: an idempotent retry of this very request.
+    if "idem" in g and g.idem[1]["waiters"] > 0:
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+    except (BlockingIOError, InterruptedError):
+        return False
+    except OSError:
+        return True
+
+def _avg_tokens(name):
+    with _metrics_lock:
+        calls = METRICS.get("upstream.calls", 0)
+        return round(METRICS.get(name, 0) / calls) if calls else 0
+
+def complete(**kwargs):
+    """
+    Streamed chat completion on the best upstream target (another one if it
+    fails) -> (text, finish_reason, prompt_tokens, completion_tokens).
+    Raises ClientGone (and stops paying) once the client disconnects.
+    """
+    if client_gone():
+        count("cancel.skipped_calls")
+        count("cancel.saved_prompt_tokens_est", _avg_tokens("upstream.prompt_tokens"))
+        count("cancel.saved_completion_tokens_est", _avg_tokens("upstream.completion_tokens"))
+        raise ClientGone()
+    tried = []
+    while True:
+        with _upstream_lock:
+            t = _pick_upstream(tried)
+            t["outstanding"] += 1
+        tried.append(t["name"])
+        t0 = time.perf_counter()
+        try:
+            text, finish, usage = _stream_from(t, kwargs)
+        except Exception as e:
+            retry, eject_s = _retryable(e)
+            with _upstream_lock:
+                t["outstanding"] -= 1
+                if retry:
+                    _upstream_failed(t, eject_s)
+            if not retry:
+                raise
+            if len(tried) >= min(UPSTREAM_ATTEMPTS, len(UPSTREAMS)):
+                raise UpstreamsBusy(_upstream_retry_after()) from e
+            continue
+        ms = (time.perf_counter() - t0) * 1000
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        with _upstream_lock:
+            t["outstanding"] -= 1
+            t["calls"] += 1
+            t["ewma_ms"] = ms if t["ewma_ms"] is None else t["ewma_ms"] + 0.3 * (ms - t["ewma_ms"])
+            t["streak"] = t["backoff"] = 0
+            t["prompt_tokens"] += prompt_tokens
+            t["completion_tokens"] += completion_tokens
+        break
+    count("upstream.calls")
+    count("upstream.prompt_tokens", prompt_tokens)
+    count("upstream.completion_tokens", completion_tokens)
+    note_usage(prompt_tokens, completion_tokens)
+    return text, finish, prompt_tokens, completion_tokens
+
+def _stream_from(t, kwargs):
+    parts, finish, usage = [], None, None
+    next_check = time.monotonic() + CANCEL_CHECK_SECS
+    kwargs = dict(kwargs, model=t["model"] or kwargs["model"])
+    with _client_for(t).chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs) as stream:
+        for chunk in stream:
+            if time.monotonic() >= next_check:
+                next_check = time.monotonic() + CANCEL_CHECK_SECS
+                if client_gone():
+                    count("cancel.aborted_calls")
+                    count("cancel.saved_completion_tokens_est", max(0, _avg_tokens("upstream.completion_tokens") - len(parts)))
+                    raise ClientGone()
+            if chunk.usage:
+                usage = chunk.usage
+            for choice in chunk.choices:
+                if choice.delta and choice.delta.content:
+                    parts.append(choice.delta.content)
+                if choice.finish_reason:
+                    finish = choice.finish_reason
+    return "".join(parts).strip(), finish, usage
+
+# ----------------------------
+# Upstream pool
+# ----------------------------
+# UPSTREAMS is a JSON list of {"name", "api_key" or "api_key_env", "base_url",
+# "model", "weight"} (same format as waspada-api/upstreams.py); without it, just
+# OPENAI_API_KEY. Calls go to the target with the lowest
+# ewma_ms * (outstanding + 1) / weight. Connection errors, timeouts, 429, 5xx and
+# auth errors move the call to another target. UPSTREAM_EJECT_AFTER failures in
+# a row eject a target for UPSTREAM_EJECT_SECS, doubling on repeats; a 429's
+# Retry-After ejects it straight away. The SDK is imported on first use so a
+# freshly started worker can answer /healthz and /version without paying for it.
+UPSTREAM_ATTEMPTS = int(os.environ.get("UPSTREAM_ATTEMPTS", "2"))
+UPSTREAM_EJECT_AFTER = int(os.environ.get("UPSTREAM_EJECT_AFTER", "3"))
+UPSTREAM_EJECT_SECS = float(os.environ.get("UPSTREAM_EJECT_SECS", "5"))
+UPSTREAM_MAX_EJECT_SECS = float(os.environ.get("UPSTREAM_MAX_EJECT_SECS", "300"))
+
+def _load_upstreams():
+    raw = os.environ.get("UPSTREAMS", "").strip()
+    specs = json.loads(raw) if raw else [{"name": "default", "api_key_env": "OPENAI_API_KEY", "base_url": os.environ.get("OPENAI_BASE_URL")}]
+    targets = []
+    for i, spec in enumerate(specs):
+        key = spec.get("api_key") or os.environ.get(spec.get("api_key_env", ""), "")
+        if not key:
+            continue
+        targets.append({
+            "name": spec.get("name") or f"upstream-{i}",
+            "api_key": key,
+            "base_url": spec.get("base_url") or None,
+            "model": spec.get("model"),
+            "weight": max(float(spec.get("weight", 1)), 0.01),
+            "client": None,
+            "outstanding": 0, "ewma_ms": None, "calls": 0, "failures": 0, "streak": 0,
+            "ejections": 0, "backoff": 0, "ejected_until": 0.0,
+            "prompt_tokens": 0, "completion_tokens": 0,
+        })
+    return targets
+
+UPSTREAMS = _load_upstreams()
+_upstream_lock = threading.Lock()
+_client_lock = threading.Lock()
+
+class UpstreamsBusy(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"all upstream targets unavailable; retry in {retry_after}s")
+        self.retry_after = retry_after
+
+def _client_for(t):
+    if t["client"] is None:
+        with _client_lock:
+            if t["client"] is None:
+                from openai import OpenAI
+                # Retries are the pool's job.
+                t["client"] = OpenAI(api_key=t["api_key"], base_url=t["base_url"], max_retries=0)
+    return t["client"]
+
+def _pick_upstream(tried):
+    # Call with _upstream_lock held.
+    now = time.monotonic()
+    candidates = [t for t in UPSTREAMS if t["name"] not in tried]
+    healthy = [t for t in candidates if t["ejected_until"] <= now]
+    if not healthy:
+        return min(candidates, key=lambda t: t["ejected_until"])
+    fresh = [t for t in healthy if t["ewma_ms"] is None]
+    if fresh:
+        return min(fresh, key=lambda t: t["outstanding"] / t["weight"])
+    return min(healthy, key=lambda t: t["ewma_ms"] * (t["outstanding"] + 1) / t["weight"])
+
+def _retryable(e):
+    import openai
+    if isinstance(e, openai.APIConnectionError):
+        return True, None
+    if isinstance(e, openai.APIStatusError):
+        if e.status_code == 429:
+            try:
+                return True, float(e.response.headers.get("retry-after", ""))
+            except ValueError:
+                return True, None
+        return e.status_code in (401, 403, 404, 408, 409) or e.status_code >= 500, None
+    return False, None
+
+def _upstream_failed(t, eject_s):
+    # Call with _upstream_lock held.
+    t["calls"] += 1
+    t["failures"] += 1
+    t["streak"] += 1
+    if eject_s is None and t["streak"] < UPSTREAM_EJECT_AFTER:
+        return
+    if eject_s is None:
+        eject_s = min(UPSTREAM_MAX_EJECT_SECS, UPSTREAM_EJECT_SECS * 2 ** t["backoff"])
+        t["backoff"] += 1
+    t["ejected_until"] = time.monotonic() + eject_s
+    t["ejections"] += 1
+    t["streak"] = 0
+
+def _upstream_retry_after():
+    with _upstream_lock:
+        soonest = min(t["ejected_until"] for t in UPSTREAMS)
+    return max(1, math.ceil(soonest - time.monotonic()))
+
+def upstream_stats():
+    now = time.monotonic()
+    keys = ("name", "base_url", "model", "weight", "outstanding", "calls", "failures", "ejections", "prompt_tokens", "completion_tokens")
+    with _upstream_lock:
+        return [
+            {**{k: t[k] for k in keys}, "ewma_ms": round(t["ewma_ms"], 1) if t["ewma_ms"] is not None else None, "ejected_for_s": max(0, round(t["ejected_until"] - now, 1))}
+            for t in UPSTREAMS
+        ]
 
 AS_OF = "27 Dec 2025"
 
@@ -119,18 +645,74 @@ MALAYSIA_CHANNELS = [
     },
 ]
 
+# JSON schema for /analyze (structured outputs, strict): the model can only
+# produce this shape, so "Bad JSON from model" becomes the rare exception.
+# `channels` is not generated; the server always attaches MALAYSIA_CHANNELS.
+def _obj(**props):
+    return {"type": "object", "properties": props, "required": list(props), "additionalProperties": False}
+
+_STR = {"type": "string"}
+_STR_LIST = {"type": "array", "items": _STR}
+_CHANNEL_REF = _obj(id={"type": "string", "enum": [c["id"] for c in MALAYSIA_CHANNELS]}, why=_STR)
+
+ANALYZE_SCHEMA = _obj(
+    risk=_obj(level={"type": "string", "enum": ["low", "medium", "high"]}, score={"type": "integer"}, summary=_STR, reasons=_STR_LIST),
+    what_ai_sees={"type": "array", "items": _obj(signal=_STR, evidence_from_image=_STR, why_it_matters=_STR)},
+    diagnosis=_obj(likely_scam_type=_STR, confidence={"type": "integer"}, explanation=_STR),
+    what_to_do_now=_obj(top_actions=_STR_LIST, next_24_hours=_STR_LIST, do_not_do=_STR_LIST),
+    recommended_contacts=_obj(primary=_CHANNEL_REF, secondary=_CHANNEL_REF),
+    evidence_to_save=_STR_LIST,
+    user_message=_STR,
+)
+
+# Output budget per UI language (Tamil needs far more tokens per character).
+ANALYZE_MAX_TOKENS = {"EN": 1200, "MS": 1300, "ZH": 1300, "TA": 2200}
+if os.environ.get("ANALYZE_MAX_TOKENS"):
+    ANALYZE_MAX_TOKENS = {k: int(os.environ["ANALYZE_MAX_TOKENS"]) for k in ANALYZE_MAX_TOKENS}
+
+# Process-local counters, served by /metrics.
+METRICS = defaultdict(int)
+_metrics_lock = threading.Lock()
+
+def count(name, n=1):
+    with _metrics_lock:
+        METRICS[name] += n
+
 def now_iso():
     return dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
 
+@app.get("/healthz")
+def healthz():
+    return jsonify(ok=True), 200
+
 @app.get("/version")
 def version():
     return jsonify(
         as_of=AS_OF,
         server_time=now_iso(),
         version=os.environ.get("RENDER_GIT_COMMIT", "dev")[:7] if os.environ.get("RENDER_GIT_COMMIT") else "dev",
-        has_key=bool(os.environ.get("OPENAI_API_KEY"))
+        has_key=bool(UPSTREAMS),
+        upstreams=len(UPSTREAMS),
     ), 200
 
+@app.get("/metrics")
+def metrics():
+    with _metrics_lock:
+        c = dict(sorted(METRICS.items()))
+    ok = c.get("analyze.ok", 0)
+    calls = c.get("upstream.analyze_calls", 0)
+    return jsonify(
+        counters=c,
+        malformed_rate=round(c.get("output.malformed", 0) / calls, 4) if calls else 0.0,
+        wasted_completion_tokens_per_success=round(c.get("output.wasted_completion_tokens", 0) / ok, 2) if ok else 0.0,
+        upstreams=upstream_stats(),
+    ), 200
+
+def busy(e):
+    resp = jsonify(error="The analysis service is busy. Please try again shortly.")
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp, 503
+
 @app.post("/chat")
 def chat():
     data = request.get_json(silent=True) or {}
@@ -138,17 +720,21 @@ def chat():
 
     if not prompt:
         return jsonify(error="Missing 'prompt'"), 400
-    if not os.environ.get("OPENAI_API_KEY"):
+    if not UPSTREAMS:
         return jsonify(error="OPENAI_API_KEY not set on server"), 500
 
     try:
-        resp = client.chat.completions.create(
+        text, _finish, _pt, _ct = complete(
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             temperature=0.2,
         )
-        text = (resp.choices[0].message.content or "").strip()
         return jsonify(output=text), 200
+    except ClientGone:
+        count("chat.cancelled")
+        return "", CLIENT_CLOSED
+    except UpstreamsBusy as e:
+        return busy(e)
     except Exception as e:
         return jsonify(error=str(e)), 500
 
@@ -162,7 +748,7 @@ def analyze():
 
     if not image:
         return jsonify(error="Missing 'image_base64'"), 400
-    if not os.environ.get("OPENAI_API_KEY"):
+    if not UPSTREAMS:
         return jsonify(error="OPENAI_API_KEY not set on server"), 500
 
     # Accept either a full data URL or raw base64
@@ -172,7 +758,7 @@ def analyze():
         data_url = "data:image/jpeg;base64," + image
 
     # Guard against insanely large payloads (Render/proxy can choke)
-    if len(data_url) > 6_000_000:
+    if len(data_url) > MAX_B64_CHARS:
         return jsonify(error="Image too large. Please use a smaller screenshot (we will compress on device)."), 413
 
     # Language hints (UI language, NOT perfect legal translation)
@@ -198,15 +784,15 @@ Your job:
 1) Explain what you can actually see in the image (signals, clues) in a grounded way.
 2) Give a risk score + level.
 3) Provide prescriptive steps: what to do NOW, next 24h, and what NOT to do.
-4) Recommend who to contact (choose best 1-2 channels), but still include all Malaysia official channels list.
+4) Recommend who to contact (choose best 1-2 channels by id). The full channel list is attached by the server.
 5) Tell the user how to preserve evidence (screenshots, bank refs, chats, URLs, app package names).
 6) Be careful: you are not police/bank. Avoid claiming certainty. Use “may / likely” appropriately.
 
-Use these Malaysia official channels (must include in output):
+Use these Malaysia official channels:
 {json.dumps(MALAYSIA_CHANNELS, ensure_ascii=False)}
 """
 
-    # Schema-ish contract (we use json_object response_format so it stays parseable)
+    # Human-readable contract; ANALYZE_SCHEMA is what's actually enforced.
     CONTRACT = """
 Return JSON with exactly these top-level keys:
 
@@ -229,7 +815,6 @@ Return JSON with exactly these top-level keys:
     "primary": { "id": "string", "why": "string" },
     "secondary": { "id": "string", "why": "string" }
   },
-  "channels": [ ...the channel objects provided... ],
   "evidence_to_save": ["..."],
   "user_message": "short reassuring line"
 }
@@ -242,38 +827,71 @@ Follow the contract below and stay Malaysia-only.
 {CONTRACT}
 """
 
-    try:
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            temperature=0.2,
-            response_format={"type": "json_object"},
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": user_prompt},
-                        {"type": "image_url", "image_url": {"url": data_url}},
-                    ],
-                },
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": user_prompt},
+                {"type": "image_url", "image_url": {"url": data_url}},
             ],
-        )
+        },
+    ]
+    count("analyze.requests")
 
-        out = (resp.choices[0].message.content or "").strip()
+    try:
+        for attempt in (1, 2):
+            out, finish, _pt, completion_tokens = complete(
+                model="gpt-4o-mini",
+                temperature=0.2,
+                max_tokens=ANALYZE_MAX_TOKENS.get(lang, ANALYZE_MAX_TOKENS["EN"]),
+                response_format={
+                    "type": "json_schema",
+                    "json_schema": {"name": "analyze_result", "strict": True, "schema": ANALYZE_SCHEMA},
+                },
+                messages=messages,
+            )
+            count("upstream.analyze_calls")
 
-        # Parse to ensure valid JSON
-        try:
-            obj = json.loads(out)
-        except Exception:
-            return jsonify(error="Bad JSON from model", raw=out), 502
+            # Parse to ensure valid JSON
+            try:
+                obj = json.loads(out)
+                if attempt == 2:
+                    count("output.reask_ok")
+                break
+            except Exception:
+                count("output.malformed")
+                count("output.wasted_completion_tokens", completion_tokens)
+                if attempt == 2:
+                    count("analyze.failed")
+                    return jsonify(error="Bad JSON from model", raw=out), 502
+                # One targeted re-ask, without re-sending the image.
+                count("output.reask")
+                if finish == "length":
+                    fix = "Your reply was cut off before the JSON was complete. Reply again with the complete JSON only, using shorter text in each field."
+                else:
+                    fix = "Your reply was not valid JSON. Reply again with the corrected JSON only."
+                messages = [
+                    messages[0],
+                    {"role": "user", "content": user_prompt},
+                    {"role": "assistant", "content": out},
+                    {"role": "user", "content": fix},
+                ]
 
-        # Ensure channels always present (fallback)
-        if "channels" not in obj:
-            obj["channels"] = MALAYSIA_CHANNELS
+        # Channels always come from the server, not the model
+        obj["channels"] = MALAYSIA_CHANNELS
 
+        count("analyze.ok")
         return jsonify(result=obj, server_time=now_iso()), 200
 
+    except ClientGone:
+        count("analyze.cancelled")
+        return "", CLIENT_CLOSED
+    except UpstreamsBusy as e:
+        count("analyze.failed")
+        return busy(e)
     except Exception as e:
+        count("analyze.failed")
         return jsonify(error=str(e)), 500
 
 if __name__ == "__main__":
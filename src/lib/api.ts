@@ -61,14 +61,18 @@ export async function analyzeScreenshot(
   return data?.result ?? data;
 }
 
-export async function getResources() {
-  const data = await fetchJson("/resources", { method: "GET" });
+export async function getResources(lang: "EN" | "MS" | "ZH" | "TA" = "EN") {
+  const data = await fetchJson(`/resources?lang=${lang}`, { method: "GET" });
   return data?.result ?? data;
 }
 
-export async function getActionPlan(scenario: string) {
-  const data = await fetchJson(`/plan/${encodeURIComponent(scenario)}`, {
-    method: "GET",
-  });
+export async function getActionPlan(
+  scenario: string,
+  lang: "EN" | "MS" | "ZH" | "TA" = "EN"
+) {
+  const data = await fetchJson(
+    `/plan/${encodeURIComponent(scenario)}?lang=${lang}`,
+    { method: "GET" }
+  );
   return data?.result ?? data;
 }
@@ -0,0 +1,96 @@
+"""
+Cold-start benchmark: what a request pays right after a free-plan spin-down.
+
+    python bench_coldstart.py [--runs 5] [--path /healthz --path /plan/money_moved]
+
+For each run it starts a fresh interpreter and reports:
+  - import_ms: `import main` alone
+  - ttfb_ms:   process spawn -> first byte of the first successful request
+  - first_<path>_ms: latency of the first hit on each extra path
+
+Prints one JSON object (medians + raw runs) so results can be diffed over time.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def import_ms() -> float:
+    code = "import time; t = time.perf_counter(); import main; print((time.perf_counter() - t) * 1000)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=HERE, capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def _get(url: str, timeout: float = 5.0) -> float:
+    t = time.perf_counter()
+    with urllib.request.urlopen(url, timeout=timeout) as r:
+        r.read(1)
+        first = time.perf_counter()
+        r.read()
+    return (first - t) * 1000
+
+
+def serve_once(paths, deadline_s: float) -> dict:
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=HERE,
+    )
+    try:
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f"server exited with {proc.returncode}")
+            if time.perf_counter() - t0 > deadline_s:
+                raise RuntimeError("server did not answer in time")
+            try:
+                _get(base + paths[0], timeout=0.5)
+                break
+            except (urllib.error.URLError, ConnectionError, socket.timeout):
+                time.sleep(0.005)
+        row = {"ttfb_ms": (time.perf_counter() - t0) * 1000}
+        for p in paths[1:]:
+            row[f"first_{p}_ms"] = _get(base + p)
+        return row
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--path", action="append", dest="paths", help="first entry is used for TTFB (default /healthz)")
+    ap.add_argument("--deadline", type=float, default=30.0, help="seconds to wait for the server to answer")
+    args = ap.parse_args(argv)
+    paths = args.paths or ["/healthz", "/plan/money_moved", "/resources"]
+
+    runs = []
+    for _ in range(args.runs):
+        row = {"import_ms": import_ms()}
+        row.update(serve_once(paths, args.deadline))
+        runs.append(row)
+
+    summary = {k: round(statistics.median(r[k] for r in runs), 1) for k in runs[0]}
+    print(json.dumps({"python": sys.version.split()[0], "median": summary, "runs": runs}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,100 @@
+"""
+Stop paying for upstream work nobody is waiting for any more.
+
+DisconnectMiddleware gives each request on the watched paths a CancelToken
+(a ContextVar, so it follows the handler into the threadpool). Once the body
+has been read, it keeps one pending `receive()` open; when the server reports
+`http.disconnect`, the token's client is marked gone. The upstream call streams
+and checks the token between chunks, so closing the stream ends generation and
+frees the worker thread within a chunk or two.
+
+A token only counts as cancelled while nobody else is waiting on the same
+computation: an idempotent retry parked on this request's result (see
+idempotency.py) holds it open with `waiters`.
+"""
+import asyncio
+import contextvars
+from typing import Iterable, Optional
+
+# nginx's "client closed request"; never sent to anyone, but it's what shows up
+# in logs and what idempotency.py knows not to keep.
+CLIENT_CLOSED = 499
+
+
+class Cancelled(Exception):
+    """
+    The client went away and nobody else needs the result.
+    """
+
+
+class CancelToken:
+    __slots__ = ("client_gone", "waiters")
+
+    def __init__(self):
+        self.client_gone = False
+        self.waiters = 0
+
+    @property
+    def cancelled(self) -> bool:
+        return self.client_gone and self.waiters <= 0
+
+
+_current: contextvars.ContextVar[Optional[CancelToken]] = contextvars.ContextVar("waspada_cancel", default=None)
+
+
+def current() -> Optional[CancelToken]:
+    return _current.get()
+
+
+def bind(token: CancelToken) -> contextvars.Token:
+    return _current.set(token)
+
+
+def unbind(reset: contextvars.Token) -> None:
+    _current.reset(reset)
+
+
+def check() -> None:
+    token = _current.get()
+    if token is not None and token.cancelled:
+        raise Cancelled()
+
+
+class DisconnectMiddleware:
+    def __init__(self, app, paths: Iterable[str]):
+        self.app = app
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("path") not in self.paths:
+            return await self.app(scope, receive, send)
+
+        # An outer middleware (idempotency) may already have made one to share.
+        token = _current.get() or CancelToken()
+        watcher: Optional[asyncio.Task] = None
+
+        async def watch():
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                token.client_gone = True
+            return message
+
+        async def receive_wrapper():
+            nonlocal watcher
+            if watcher is not None:
+                # The watcher owns the channel now; hand its message over.
+                return await asyncio.shield(watcher)
+            message = await receive()
+            if message["type"] == "http.request" and not message.get("more_body", False):
+                watcher = asyncio.ensure_future(watch())
+            elif message["type"] == "http.disconnect":
+                token.client_gone = True
+            return message
+
+        reset = _current.set(token)
+        try:
+            await self.app(scope, receive_wrapper, send)
+        finally:
+            _current.reset(reset)
+            if watcher is not None and not watcher.done():
+                watcher.cancel()
@@ -0,0 +1,135 @@
+"""
+Prebuilt, pre-serialized payloads for the static endpoints (/resources, /plan).
+
+`python catalogs.py` runs at deploy time (see render.yaml) and writes one
+`key<TAB>json` line per response and language. At runtime we only split lines:
+no pydantic models are built, no translation tables are read and nothing is
+re-encoded on the request path. The only per-request work is swapping
+DATE_TOKEN for today's date.
+
+Translations live in i18n/<lang>.json as {"English source string": "translation"}.
+Anything missing falls back to English, so a new English string never breaks a
+build; `python catalogs.py` reports what is untranslated.
+"""
+import json
+import os
+import sys
+from typing import Any, Dict, Optional
+
+DEFAULT_FILENAME = "catalogs.tsv"
+
+I18N_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "i18n")
+
+# Values that are identifiers/links, not prose: never translated.
+UNTRANSLATED_KEYS = {"id", "url", "value", "type", "scenario", "source_ids", "last_verified"}
+
+# Placeholder for dates that must be "today" when served (last_verified).
+DATE_TOKEN = "@@TODAY@@"
+_DATE_TOKEN_B = DATE_TOKEN.encode()
+
+
+def load_translations(lang: str) -> Dict[str, str]:
+    if lang == "EN":
+        return {}
+    try:
+        with open(os.path.join(I18N_DIR, lang.lower() + ".json"), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def translate(obj: Any, table: Dict[str, str], missing: Optional[set] = None) -> Any:
+    """
+    Copy of `obj` with every prose string looked up in `table`.
+    """
+    if isinstance(obj, dict):
+        return {k: (v if k in UNTRANSLATED_KEYS else translate(v, table, missing)) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [translate(x, table, missing) for x in obj]
+    if isinstance(obj, str) and obj != DATE_TOKEN:
+        out = table.get(obj)
+        if out is None:
+            if missing is not None:
+                missing.add(obj)
+            return obj
+        return out
+    return obj
+
+
+def serialize(obj: Any) -> bytes:
+    # Same encoding as fastapi's JSONResponse, so clients can't tell the difference.
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+class Catalog:
+    def __init__(self, entries: Dict[str, bytes]):
+        self._entries = entries
+        # Last rendered copy per key; dates only change once a day.
+        self._rendered: Dict[str, tuple] = {}
+
+    @classmethod
+    def from_entries(cls, entries: Dict[str, Any]) -> "Catalog":
+        return cls({k: serialize(v) for k, v in entries.items()})
+
+    @classmethod
+    def load(cls, path: str) -> Optional["Catalog"]:
+        try:
+            with open(path, "rb") as f:
+                raw = f.read()
+        except OSError:
+            return None
+        entries = {}
+        for line in raw.splitlines():
+            if not line:
+                continue
+            key, _, body = line.partition(b"\t")
+            entries[key.decode("utf-8")] = body
+        return cls(entries)
+
+    def keys(self):
+        return self._entries.keys()
+
+    def render(self, key: str, day: str) -> bytes:
+        hit = self._rendered.get(key)
+        if hit is not None and hit[0] == day:
+            return hit[1]
+        body = self._entries[key].replace(_DATE_TOKEN_B, day.encode("utf-8"))
+        self._rendered[key] = (day, body)
+        return body
+
+    def write(self, path: str) -> None:
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            for key in sorted(self._entries):
+                f.write(key.encode("utf-8") + b"\t" + self._entries[key] + b"\n")
+        os.replace(tmp, path)
+
+
+def main(argv=None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    here = os.path.dirname(os.path.abspath(__file__))
+    path = argv[0] if argv else os.path.join(here, DEFAULT_FILENAME)
+
+    # Imported here, not at module level: main imports this module.
+    import main as api
+
+    entries = api.build_catalog_entries()
+    cat = Catalog.from_entries(entries)
+    cat.write(path)
+    print(f"wrote {len(cat.keys())} catalog entries to {path}")
+
+    english = {k: v for k, v in entries.items() if k.endswith("/EN")}
+    for lang in api.Lang.__args__:
+        if lang == "EN":
+            continue
+        missing: set = set()
+        translate(list(english.values()), load_translations(lang), missing)
+        if missing:
+            print(f"{lang}: {len(missing)} untranslated string(s), served in English:")
+            for m in sorted(missing):
+                print(f"  {m}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
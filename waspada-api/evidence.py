@@ -0,0 +1,147 @@
+"""
+Evidence pack export: analysis result + screenshots -> ZIP, streamed.
+
+The archive is written into a tiny in-memory sink that is drained after every
+chunk, so only one read chunk plus the compressor's window is ever held, no
+matter how many screenshots are in the pack. Uploads themselves are spooled to
+disk by the multipart parser. Layout:
+
+    images/01-<name>.<ext>   the screenshots, as uploaded
+    summary.html             printable summary for NSRC / PDRM / the bank
+    result.json              the analysis result
+    manifest.json            sha256 + size of every file above
+"""
+import hashlib
+import html
+import json
+import os
+import re
+import time
+import zipfile
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+CHUNK = 64 * 1024
+
+_SAFE_NAME = re.compile(r"[^A-Za-z0-9._-]+")
+
+
+class _Sink:
+    """
+    Write-only, non-seekable file object; zipfile falls back to data
+    descriptors, which is what lets the archive stream.
+    """
+
+    def __init__(self):
+        self._parts: List[bytes] = []
+
+    def write(self, b) -> int:
+        self._parts.append(bytes(b))
+        return len(b)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        out = b"".join(self._parts)
+        self._parts.clear()
+        return out
+
+
+def image_entry_name(index: int, filename: Optional[str], content_type: str) -> str:
+    base, ext = os.path.splitext(os.path.basename(filename or ""))
+    base = _SAFE_NAME.sub("-", base).strip("-._")[:40] or "screenshot"
+    ext = _SAFE_NAME.sub("", ext)[:6].lower() or "." + (content_type.split("/", 1)[-1].split(";")[0] or "img")
+    if not ext.startswith("."):
+        ext = "." + ext
+    return f"images/{index:02d}-{base}{ext}"
+
+
+def _li(items) -> str:
+    return "".join(f"<li>{html.escape(str(x))}</li>" for x in items or [] if x)
+
+
+def render_summary(result: Dict[str, Any], files: List[Dict[str, Any]], note: str, generated_at: str) -> str:
+    actions = "".join(
+        f"<li>{html.escape(a.get('step') or '')}" + (f"<br><small>{html.escape(a['why'])}</small>" if a.get("why") else "") + "</li>"
+        for a in result.get("recommended_next_actions") or []
+    )
+    contacts = "".join(
+        f"<li>{html.escape(c.get('name') or '')}: {html.escape(c.get('value') or '')}</li>"
+        for c in result.get("who_to_contact") or []
+    )
+    sources = "".join(
+        f"<li>{html.escape(s.get('org') or '')} — {html.escape(s.get('title') or '')}: {html.escape(s.get('url') or '')}</li>"
+        for s in result.get("sources") or []
+    )
+    rows = "".join(
+        f"<tr><td>{html.escape(f['name'])}</td><td>{f['bytes']}</td><td><code>{f['sha256']}</code></td></tr>" for f in files
+    )
+    return f"""<!doctype html>
+<html lang="en"><head><meta charset="utf-8"><title>Waspada evidence summary</title>
+<style>body{{font-family:sans-serif;max-width:48em;margin:2em auto;line-height:1.4}}td,th{{padding:.2em .5em;text-align:left}}code{{font-size:.8em}}</style>
+</head><body>
+<h1>Evidence summary</h1>
+<p>Generated {html.escape(generated_at)} by Waspada. Automated, pattern-based triage; not an official finding.</p>
+<h2>Assessment</h2>
+<ul>
+<li>Verdict: {html.escape(str(result.get("verdict", "")))}</li>
+<li>Risk: {html.escape(str(result.get("risk", "")))}</li>
+<li>Scenario: {html.escape(str(result.get("scenario", "")))}</li>
+</ul>
+{f"<h2>User note</h2><p>{html.escape(note)}</p>" if note else ""}
+<h2>What the screenshots show</h2><ul>{_li(result.get("what_the_screenshot_shows"))}</ul>
+{f"<p>{html.escape(result['analysis'])}</p>" if result.get("analysis") else ""}
+<h2>Findings</h2><ul>{_li(result.get("findings"))}</ul>
+<h2>Recommended next actions</h2><ol>{actions}</ol>
+<h2>Who to contact</h2><ul>{contacts}</ul>
+<h2>Evidence to keep</h2><ul>{_li(result.get("evidence_to_save"))}</ul>
+<h2>Attached files</h2>
+<table><tr><th>File</th><th>Bytes</th><th>SHA-256</th></tr>{rows}</table>
+<h2>Sources</h2><ul>{sources}</ul>
+<p><small>{html.escape(result.get("caveat") or "")}</small></p>
+</body></html>
+"""
+
+
+async def stream_pack(result: Dict[str, Any], uploads: List[Any], note: str = "") -> AsyncIterator[bytes]:
+    """
+    Yield the ZIP in pieces. `uploads` are starlette UploadFiles (async read).
+    """
+    generated_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    sink = _Sink()
+    zf = zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6)
+    files: List[Dict[str, Any]] = []
+
+    def add_bytes(name: str, data: bytes, content_type: str) -> None:
+        with zf.open(name, "w") as dst:
+            dst.write(data)
+        files.append({"name": name, "content_type": content_type, "bytes": len(data), "sha256": hashlib.sha256(data).hexdigest()})
+
+    for i, up in enumerate(uploads, start=1):
+        name = image_entry_name(i, up.filename, up.content_type or "")
+        zinfo = zipfile.ZipInfo(name, date_time=time.gmtime()[:6])
+        # Screenshots are already compressed; level 1 keeps CPU low.
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo._compresslevel = 1
+        h = hashlib.sha256()
+        size = 0
+        with zf.open(zinfo, "w") as dst:
+            while True:
+                data = await up.read(CHUNK)
+                if not data:
+                    break
+                h.update(data)
+                size += len(data)
+                dst.write(data)
+                out = sink.take()
+                if out:
+                    yield out
+        files.append({"name": name, "content_type": up.content_type, "bytes": size, "sha256": h.hexdigest()})
+
+    add_bytes("summary.html", render_summary(result, files, note, generated_at).encode("utf-8"), "text/html")
+    add_bytes("result.json", json.dumps(result, ensure_ascii=False, indent=2).encode("utf-8"), "application/json")
+    manifest = {"generated_at": generated_at, "generator": "waspada-api", "files": files}
+    with zf.open("manifest.json", "w") as dst:
+        dst.write(json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8"))
+    zf.close()
+    yield sink.take()
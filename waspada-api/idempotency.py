@@ -0,0 +1,254 @@
+"""
+Idempotency-Key support for expensive POSTs (pure ASGI).
+
+The first request with a given key runs normally and its response is kept for
+`ttl_s`. A retry with the same key and the same body gets that response back
+(with `Idempotent-Replayed: true`) instead of a second upstream call; a retry
+that arrives while the first is still running waits for it. Reusing a key with
+a different body is a 422. Keys are scoped per client and path.
+
+5xx responses, requests that end in an exception and requests abandoned by a
+disconnected client aren't kept, so a retry after a real failure runs again.
+While retries are waiting, the first request's CancelToken is held open so a
+disconnect of the original client doesn't throw away work they need.
+Everything runs on the event loop, so no locks.
+"""
+import asyncio
+import contextvars
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import cancel
+from ratelimit import client_key
+
+MAX_KEY_LENGTH = 255
+
+# Upstream tokens spent by the current request, so a replay can report what it
+# saved. Sync handlers run in a copied context but share this dict.
+_usage: contextvars.ContextVar[Optional[Dict[str, int]]] = contextvars.ContextVar("waspada_idem_usage", default=None)
+
+
+def record_usage(prompt_tokens: int, completion_tokens: int) -> None:
+    box = _usage.get()
+    if box is not None:
+        box["prompt_tokens"] += prompt_tokens
+        box["completion_tokens"] += completion_tokens
+
+
+class Entry:
+    __slots__ = ("fingerprint", "done", "status", "headers", "body", "usage", "expires", "token")
+
+    def __init__(self, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.done = asyncio.Event()
+        self.status: Optional[int] = None  # None until a response is stored
+        self.headers: List[Tuple[bytes, bytes]] = []
+        self.body = b""
+        self.usage = {"prompt_tokens": 0, "completion_tokens": 0}
+        self.expires = float("inf")  # pending entries never expire
+        self.token = cancel.CancelToken()
+
+
+class IdempotencyStore:
+    def __init__(self, ttl_s: float = 3600.0, max_keys: int = 10_000, max_body: int = 1024 * 1024):
+        self.ttl_s = ttl_s
+        self.max_keys = max_keys
+        self.max_body = max_body
+        self._entries: "OrderedDict[Tuple[str, str, str], Entry]" = OrderedDict()
+        self.counts = {"stored": 0, "replayed": 0, "waited": 0, "mismatched": 0, "timed_out": 0, "abandoned": 0}
+        self.saved = {"upstream_prompt_tokens": 0, "upstream_completion_tokens": 0}
+
+    def get(self, key) -> Optional[Entry]:
+        e = self._entries.get(key)
+        if e is not None and e.expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        return e
+
+    def start(self, key, fingerprint: str) -> Entry:
+        e = self._entries[key] = Entry(fingerprint)
+        self._entries.move_to_end(key)
+        self._evict()
+        return e
+
+    def finish(self, key, entry: Entry, keep: bool) -> None:
+        if keep:
+            entry.expires = time.monotonic() + self.ttl_s
+            self.counts["stored"] += 1
+            # Re-insert at the back, so the front stays in expiry order.
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+        elif self._entries.get(key) is entry:
+            del self._entries[key]
+        entry.done.set()
+
+    def replayed(self, entry: Entry) -> None:
+        self.counts["replayed"] += 1
+        self.saved["upstream_prompt_tokens"] += entry.usage["prompt_tokens"]
+        self.saved["upstream_completion_tokens"] += entry.usage["completion_tokens"]
+
+    def _evict(self) -> None:
+        entries = self._entries
+        while len(entries) > self.max_keys:
+            entries.popitem(last=False)
+        now = time.monotonic()
+        while entries:
+            first = next(iter(entries.values()))
+            if first.expires > now:
+                break
+            entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"keys": len(self._entries), **self.counts, "saved": dict(self.saved)}
+
+
+class IdempotencyMiddleware:
+    """
+    Sits inside BodyLimitMiddleware: it buffers the body to fingerprint it, and
+    that read must still go through the size limit and image budget.
+    """
+
+    def __init__(
+        self,
+        app,
+        store: IdempotencyStore,
+        paths: Iterable[str],
+        wait_s: float = 60.0,
+        use_device_token: bool = True,
+        trust_proxy: bool = True,
+    ):
+        self.app = app
+        self.store = store
+        self.paths = set(paths)
+        self.wait_s = wait_s
+        self.use_device_token = use_device_token
+        self.trust_proxy = trust_proxy
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("method") != "POST" or scope.get("path") not in self.paths:
+            return await self.app(scope, receive, send)
+        raw_key = None
+        for k, v in scope.get("headers", ()):
+            if k == b"idempotency-key":
+                raw_key = v
+                break
+        if raw_key is None:
+            return await self.app(scope, receive, send)
+        if not raw_key or len(raw_key) > MAX_KEY_LENGTH:
+            return await _send_json(send, 400, f"Idempotency-Key must be 1-{MAX_KEY_LENGTH} characters")
+
+        # Fingerprint the body while buffering it; the app gets it replayed.
+        chunks: List[bytes] = []
+        h = hashlib.sha256()
+        while True:
+            message = await receive()
+            if message["type"] != "http.request":
+                return  # client went away before the body arrived
+            body = message.get("body", b"")
+            chunks.append(body)
+            h.update(body)
+            if not message.get("more_body", False):
+                break
+        fingerprint = h.hexdigest()
+        key = (scope["path"], client_key(scope, self.use_device_token, self.trust_proxy), raw_key.decode("latin-1"))
+
+        store = self.store
+        while True:
+            entry = store.get(key)
+            if entry is None:
+                break
+            if entry.fingerprint != fingerprint:
+                store.counts["mismatched"] += 1
+                return await _send_json(send, 422, "Idempotency-Key was already used with a different request body")
+            if not entry.done.is_set():
+                store.counts["waited"] += 1
+                outcome = await self._wait(entry, receive)
+                if outcome == "gone":
+                    store.counts["abandoned"] += 1
+                    return
+                if outcome == "timeout":
+                    store.counts["timed_out"] += 1
+                    return await _send_json(send, 409, "A request with this Idempotency-Key is still in progress", retry_after=5)
+            if entry.status is not None:
+                store.replayed(entry)
+                headers = entry.headers + [(b"idempotent-replayed", b"true")]
+                await send({"type": "http.response.start", "status": entry.status, "headers": headers})
+                await send({"type": "http.response.body", "body": entry.body})
+                return
+            # The first attempt failed and wasn't kept: loop and run it ourselves.
+
+        entry = store.start(key, fingerprint)
+        pending = chunks
+
+        async def replay_receive():
+            nonlocal pending
+            if pending is not None:
+                body, pending = b"".join(pending), None
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        status: Optional[int] = None
+        headers: List[Tuple[bytes, bytes]] = []
+        parts: List[bytes] = []
+        size = 0
+
+        async def send_wrapper(message):
+            nonlocal status, headers, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", ()))
+            elif message["type"] == "http.response.body":
+                body = message.get("body", b"")
+                size += len(body)
+                if size <= store.max_body:
+                    parts.append(body)
+            await send(message)
+
+        token = _usage.set(entry.usage)
+        bound = cancel.bind(entry.token)
+        keep = False
+        try:
+            await self.app(scope, replay_receive, send_wrapper)
+            keep = status is not None and status < 500 and status != cancel.CLIENT_CLOSED and size <= store.max_body
+        finally:
+            cancel.unbind(bound)
+            _usage.reset(token)
+            if keep:
+                entry.status = status
+                entry.headers = headers
+                entry.body = b"".join(parts)
+            store.finish(key, entry, keep)
+
+    async def _wait(self, entry: Entry, receive) -> str:
+        """
+        Wait for the first request to finish -> "done", "timeout", or "gone"
+        when this client disconnects first. The body is already read, so the
+        next receive() only returns on disconnect.
+        """
+        entry.token.waiters += 1
+        done = asyncio.ensure_future(entry.done.wait())
+        gone = asyncio.ensure_future(receive())
+        try:
+            finished, _ = await asyncio.wait({done, gone}, timeout=self.wait_s, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            entry.token.waiters -= 1
+            for t in (done, gone):
+                if not t.done():
+                    t.cancel()
+        if done in finished:
+            return "done"
+        if gone in finished and gone.result()["type"] == "http.disconnect":
+            return "gone"
+        return "timeout"
+
+
+async def _send_json(send, status: int, detail: str, retry_after: Optional[int] = None) -> None:
+    body = json.dumps({"detail": detail}).encode("utf-8")
+    headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    if retry_after:
+        headers.append((b"retry-after", str(retry_after).encode()))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,338 @@
+"""
+Local lookup index for reported phone numbers, bank accounts and domains.
+
+A snapshot is one file, built offline by `python indicators.py build ...`:
+
+    header (64 bytes)   magic, entry count, Bloom size, hash count, build time
+    Bloom filter        bloom_bits / 8 bytes
+    keys                sorted little-endian uint64, one per indicator
+
+Each indicator is normalized, then hashed as blake2b("<type>:<value>"). The
+first 8 bytes are the stored key and the second 8 drive the Bloom probes. The
+file is memory-mapped, so the OS pages it in on demand and shares it across
+workers: resident memory is whatever the lookups actually touch, not 8 bytes x
+entries. Most lookups miss and are answered by the Bloom filter alone; hits
+are confirmed by a binary search over the mmapped keys.
+
+Only hashes are stored, so the snapshot can't be turned back into a list. A
+match means "this value hashes to a reported indicator"; with 64-bit keys a
+false match is negligible at any realistic list size.
+
+New snapshots are published with an atomic rename (the builder does this). The
+index re-stats the path at most every `check_every_s` and maps the new file when
+it changed; the old mapping is released once no lookup holds it any more.
+"""
+import bisect
+import hashlib
+import mmap
+import math
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+DEFAULT_FILENAME = "indicators.idx"
+
+KINDS = ("phone", "account", "domain")
+
+MAGIC = b"WSPIDX01"
+_HEADER = struct.Struct("<8sQQId")  # magic, count, bloom_bits, k, built_at
+HEADER_SIZE = 64
+
+
+# ----------------------------
+# Normalization
+# ----------------------------
+_NON_DIGIT = re.compile(r"\D+")
+
+
+def normalize_phone(value: str) -> Optional[str]:
+    """
+    Malaysian numbers to E.164 digits without the plus: 012-345 6789,
+    +6012 3456789 and 60123456789 all become 60123456789.
+    """
+    d = _NON_DIGIT.sub("", value or "")
+    if d.startswith(("1300", "1800")) and len(d) == 10:
+        return d  # toll/shared-cost numbers have no country prefix in use
+    if d.startswith("0060"):
+        d = d[2:]
+    if d.startswith("60"):
+        pass
+    elif d.startswith("0"):
+        d = "6" + d
+    elif d.startswith("1") and len(d) in (9, 10):
+        d = "60" + d  # mobile typed without the trunk 0
+    else:
+        return None
+    return d if 10 <= len(d) <= 12 else None
+
+
+def normalize_account(value: str) -> Optional[str]:
+    d = _NON_DIGIT.sub("", value or "")
+    return d if 8 <= len(d) <= 20 else None
+
+
+def normalize_domain(value: str) -> Optional[str]:
+    """
+    Host part of a URL or bare domain, lowercased, IDNA-encoded, without www.
+    """
+    s = (value or "").strip().lower()
+    if not s:
+        return None
+    if "://" not in s:
+        s = "http://" + s
+    try:
+        host = urlsplit(s).hostname or ""
+    except ValueError:
+        return None
+    host = host.strip(".")
+    if host.startswith("www."):
+        host = host[4:]
+    if "." not in host:
+        return None
+    try:
+        host = host.encode("idna").decode("ascii")
+    except UnicodeError:
+        return None
+    return host
+
+
+def normalize(kind: str, value: str) -> Optional[str]:
+    if kind == "phone":
+        return normalize_phone(value)
+    if kind == "account":
+        return normalize_account(value)
+    if kind in ("domain", "url"):
+        return normalize_domain(value)
+    return None
+
+
+def domain_candidates(domain: str) -> List[str]:
+    """
+    a.b.example.com -> itself and each parent down to two labels, so a listed
+    domain also covers its subdomains.
+    """
+    labels = domain.split(".")
+    return [".".join(labels[i:]) for i in range(len(labels) - 1)]
+
+
+def _hash(kind: str, norm: str) -> Tuple[int, int]:
+    d = hashlib.blake2b(f"{kind}:{norm}".encode("utf-8"), digest_size=16).digest()
+    return int.from_bytes(d[:8], "little"), int.from_bytes(d[8:], "little") | 1
+
+
+# ----------------------------
+# Snapshot
+# ----------------------------
+class Snapshot:
+    def __init__(self, path: str):
+        if sys.byteorder != "little":
+            raise RuntimeError("indicator snapshots are little-endian")
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, bloom_bits, k, built_at = _HEADER.unpack_from(self._mm, 0)
+        bloom_bytes = bloom_bits // 8
+        if magic != MAGIC or len(self._mm) != HEADER_SIZE + bloom_bytes + 8 * count:
+            raise ValueError(f"{path}: not a valid indicator snapshot")
+        self.path = path
+        self.stat_key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        self.count = count
+        self.built_at = built_at
+        self.loaded_at = time.time()
+        self._bloom_bits = bloom_bits
+        self._k = k
+        self._bloom = memoryview(self._mm)[HEADER_SIZE:HEADER_SIZE + bloom_bytes]
+        self._keys = memoryview(self._mm)[HEADER_SIZE + bloom_bytes:].cast("Q")
+
+    def contains(self, kind: str, norm: str) -> bool:
+        h1, h2 = _hash(kind, norm)
+        m = self._bloom_bits
+        if not m:
+            return False
+        bloom = self._bloom
+        for i in range(self._k):
+            bit = (h1 + i * h2) % m
+            if not bloom[bit >> 3] & (1 << (bit & 7)):
+                return False
+        keys = self._keys
+        i = bisect.bisect_left(keys, h1)
+        return i < len(keys) and keys[i] == h1
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "entries": self.count,
+            "built_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.built_at)),
+            "loaded_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.loaded_at)),
+            "bytes": len(self._mm),
+        }
+
+
+class IndicatorIndex:
+    """
+    The current snapshot for `path`, swapped for a newer one when the file is
+    replaced. A missing or broken file leaves the last good snapshot in place.
+    """
+
+    def __init__(self, path: str, check_every_s: float = 30.0):
+        self.path = path
+        self.check_every_s = check_every_s
+        self._snap: Optional[Snapshot] = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self.reloads = 0
+        self.errors = 0
+
+    def snapshot(self) -> Optional[Snapshot]:
+        now = time.monotonic()
+        if now >= self._next_check and self._lock.acquire(blocking=False):
+            try:
+                self._next_check = now + self.check_every_s
+                self._maybe_reload()
+            finally:
+                self._lock.release()
+        return self._snap
+
+    def _maybe_reload(self) -> None:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        cur = self._snap
+        if cur is not None and cur.stat_key == (st.st_ino, st.st_mtime_ns, st.st_size):
+            return
+        try:
+            snap = Snapshot(self.path)
+        except (OSError, ValueError, RuntimeError):
+            self.errors += 1
+            return
+        self._snap = snap  # a single reference swap; readers see old or new
+        self.reloads += 1
+
+    def lookup(self, kind: str, value: str) -> Dict[str, Any]:
+        """
+        -> {"type", "normalized", "match"}; normalized is None when the value
+        isn't a plausible phone / account / domain.
+        """
+        snap = self.snapshot()
+        norm = normalize(kind, value)
+        kind = "domain" if kind == "url" else kind
+        match = False
+        if snap is not None and norm:
+            if kind == "domain":
+                match = any(snap.contains(kind, d) for d in domain_candidates(norm))
+            else:
+                match = snap.contains(kind, norm)
+        return {"type": kind, "normalized": norm, "match": match}
+
+    def stats(self) -> Dict[str, Any]:
+        snap = self._snap
+        return {
+            "loaded": snap is not None,
+            "reloads": self.reloads,
+            "errors": self.errors,
+            **(snap.info() if snap else {}),
+        }
+
+
+# ----------------------------
+# Building
+# ----------------------------
+def build(entries: Iterable[Tuple[str, str]], path: str, fp_rate: float = 0.01) -> Dict[str, int]:
+    """
+    Write a snapshot for (kind, raw value) pairs to `path`, atomically.
+    """
+    from array import array
+
+    h1s: Dict[int, int] = {}
+    skipped = 0
+    for kind, raw in entries:
+        norm = normalize(kind, raw)
+        if not norm:
+            skipped += 1
+            continue
+        kind = "domain" if kind == "url" else kind
+        h1, h2 = _hash(kind, norm)
+        h1s[h1] = h2
+
+    n = len(h1s)
+    # Standard sizing: m = -n ln p / (ln 2)^2, k = m/n ln 2; m rounded up to 64.
+    m = max(64, math.ceil(-n * math.log(fp_rate) / (math.log(2) ** 2) / 64) * 64) if n else 0
+    k = max(1, round(m / n * math.log(2))) if n else 0
+    bloom = bytearray(m // 8)
+    for h1, h2 in h1s.items():
+        for i in range(k):
+            bit = (h1 + i * h2) % m
+            bloom[bit >> 3] |= 1 << (bit & 7)
+    keys = array("Q", sorted(h1s))
+    if sys.byteorder != "little":
+        keys.byteswap()
+
+    tmp = f"{path}.tmp.{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, n, m, k, time.time()).ljust(HEADER_SIZE, b"\0"))
+        f.write(bloom)
+        keys.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return {"entries": n, "skipped": skipped, "bloom_bits": m, "hashes": k}
+
+
+def read_entries(paths: List[str], default_kind: Optional[str] = None) -> Iterable[Tuple[str, str]]:
+    """
+    Lines of `type,value` (or `type<TAB>value`); with default_kind, bare values.
+    Blank lines and # comments are skipped.
+    """
+    for p in paths:
+        with open(p, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if default_kind:
+                    yield default_kind, line
+                    continue
+                kind, sep, value = line.replace("\t", ",").partition(",")
+                if sep and kind.strip().lower() in KINDS + ("url",):
+                    yield kind.strip().lower(), value.strip()
+
+
+def main(argv=None) -> int:
+    import argparse
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    ap = argparse.ArgumentParser(description="Build or query an indicator snapshot.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build", help="build a snapshot from type,value lists")
+    b.add_argument("inputs", nargs="+")
+    b.add_argument("-o", "--output", default=os.path.join(here, DEFAULT_FILENAME))
+    b.add_argument("--type", choices=KINDS + ("url",), help="inputs are bare values of this type")
+    b.add_argument("--fp-rate", type=float, default=0.01, help="Bloom false-positive rate")
+    q = sub.add_parser("check", help="look values up in a snapshot")
+    q.add_argument("type", choices=KINDS + ("url",))
+    q.add_argument("values", nargs="+")
+    q.add_argument("-i", "--index", default=os.path.join(here, DEFAULT_FILENAME))
+    args = ap.parse_args(argv)
+
+    if args.cmd == "build":
+        out = build(read_entries(args.inputs, args.type), args.output, args.fp_rate)
+        print(f"wrote {out['entries']} indicators to {args.output} ({out['skipped']} skipped as unparseable)")
+        return 0
+
+    index = IndicatorIndex(args.index)
+    if index.snapshot() is None:
+        print(f"no usable snapshot at {args.index}", file=sys.stderr)
+        return 1
+    for v in args.values:
+        r = index.lookup(args.type, v)
+        print(f"{v}\t{r['normalized']}\t{'MATCH' if r['match'] else '-'}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,165 @@
+"""
+Request-body limits enforced while the body streams in (pure ASGI, no buffering).
+
+- Content-Length over the limit: 413 before a single body byte is read.
+- Chunked / lying Content-Length: counted chunk by chunk, 413 as soon as the
+  running total passes the limit.
+- Image routes additionally reserve their bytes from a per-process budget
+  (InflightBudget). When it is exhausted new uploads wait briefly, then get 503.
+  A burst of large screenshots queues up instead of pushing the instance out
+  of memory.
+"""
+import asyncio
+import json
+from typing import Dict, Iterable, Optional
+
+from starlette.exceptions import HTTPException
+
+
+class BodyTooLarge(HTTPException):
+    def __init__(self, limit: int):
+        super().__init__(status_code=413, detail=f"Request body too large (limit {limit} bytes). Please use a smaller screenshot.")
+
+
+class BudgetExhausted(HTTPException):
+    def __init__(self, retry_after: int):
+        super().__init__(
+            status_code=503,
+            detail="Server is busy processing other images. Please retry shortly.",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+class InflightBudget:
+    """
+    Upper bound on image bytes held by requests in flight in this process.
+    Single event loop, so plain ints guarded by one Condition are enough.
+    """
+
+    def __init__(self, max_bytes: int, wait_s: float):
+        self.max_bytes = max_bytes
+        self.wait_s = wait_s
+        self.in_use = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._cond: Optional[asyncio.Condition] = None
+
+    def _condition(self) -> asyncio.Condition:
+        # Created lazily so it binds to the server's loop, not the import-time one.
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def acquire(self, n: int) -> None:
+        if n > self.max_bytes:
+            self.rejected += 1
+            raise BodyTooLarge(self.max_bytes)
+        cond = self._condition()
+        async with cond:
+            if self.in_use + n > self.max_bytes:
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(cond.wait_for(lambda: self.in_use + n <= self.max_bytes), self.wait_s)
+                except asyncio.TimeoutError:
+                    self.rejected += 1
+                    raise BudgetExhausted(retry_after=max(1, int(self.wait_s)))
+                finally:
+                    self.waiting -= 1
+            self.in_use += n
+
+    async def release(self, n: int) -> None:
+        if n <= 0:
+            return
+        cond = self._condition()
+        async with cond:
+            self.in_use -= n
+            cond.notify_all()
+
+    def stats(self) -> Dict[str, int]:
+        return {"max_bytes": self.max_bytes, "in_use": self.in_use, "waiting": self.waiting, "rejected": self.rejected}
+
+
+class BodyLimitMiddleware:
+    def __init__(
+        self,
+        app,
+        max_bytes: int,
+        path_limits: Optional[Dict[str, int]] = None,
+        budget: Optional[InflightBudget] = None,
+        budget_paths: Iterable[str] = (),
+    ):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.path_limits = path_limits or {}
+        self.budget = budget
+        self.budget_paths = set(budget_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        path = scope.get("path", "")
+        limit = self.path_limits.get(path, self.max_bytes)
+        budget = self.budget if path in self.budget_paths else None
+
+        declared = None
+        for k, v in scope.get("headers", ()):
+            if k == b"content-length":
+                try:
+                    declared = int(v)
+                except ValueError:
+                    declared = None
+                break
+
+        started = False
+
+        async def send_wrapper(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        reserved = 0
+        try:
+            if declared is not None and declared > limit:
+                raise BodyTooLarge(limit)
+            if budget is not None and declared:
+                await budget.acquire(declared)
+                reserved = declared
+
+            received = 0
+
+            async def receive_wrapper():
+                nonlocal received, reserved
+                message = await receive()
+                if message["type"] == "http.request":
+                    n = len(message.get("body", b""))
+                    received += n
+                    if received > limit:
+                        raise BodyTooLarge(limit)
+                    # No (or a too-small) Content-Length: reserve as bytes arrive.
+                    if budget is not None and received > reserved:
+                        extra = received - reserved
+                        await budget.acquire(extra)
+                        reserved += extra
+                return message
+
+            await self.app(scope, receive_wrapper, send_wrapper)
+        except HTTPException as e:
+            if not isinstance(e, (BodyTooLarge, BudgetExhausted)) or started:
+                raise
+            await _send_error(send, e)
+        finally:
+            if budget is not None:
+                await budget.release(reserved)
+
+
+async def _send_error(send, exc: HTTPException) -> None:
+    body = json.dumps({"detail": exc.detail}).encode("utf-8")
+    headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    for k, v in (exc.headers or {}).items():
+        headers.append((k.lower().encode(), v.encode()))
+    # Unread body left on the socket: don't let the client reuse this connection.
+    headers.append((b"connection", b"close"))
+    await send({"type": "http.response.start", "status": exc.status_code, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
@@ -1,18 +1,35 @@
 import os
 import re
 import json
+import logging
+import threading
+import importlib.util
+from contextlib import asynccontextmanager
 from datetime import date
 from typing import List, Optional, Literal, Dict, Any
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel, Field
 
+import cancel
+import catalogs
+import evidence
+import idempotency
+import indicators
+import metrics
+import upstreams
+from limits import BodyLimitMiddleware, InflightBudget
+from profiling import ProfileStore, ProfilingMiddleware, is_admin, profiled
+from ratelimit import RateLimitMiddleware, Rule, TokenBuckets, rule_from_env
+
 # ---- OpenAI (new SDK) ----
-try:
-    from openai import OpenAI
-except Exception as e:
-    OpenAI = None
+# Imported lazily in upstreams.Target.client(): the SDK is the heaviest import we have and
+# a cold start on the free plan shouldn't pay for it before /healthz answers.
+_OPENAI_AVAILABLE = importlib.util.find_spec("openai") is not None
+
+log = logging.getLogger("waspada")
 
 
 # ----------------------------
@@ -64,6 +81,18 @@ class Contact(BaseModel):
     notes: Optional[str] = None
     source_ids: Optional[List[str]] = None
 
+class IndicatorCheck(BaseModel):
+    checked: int
+    matched: int
+    matched_types: List[str] = []
+
+class CheckItem(BaseModel):
+    type: Literal["phone", "account", "domain", "url"]
+    value: str = Field(..., max_length=512)
+
+class CheckIn(BaseModel):
+    items: List[CheckItem] = Field(..., min_length=1, max_length=50)
+
 class VerifyResult(BaseModel):
     verdict: Verdict
     risk: Risk
@@ -81,12 +110,143 @@ class VerifyResult(BaseModel):
 
     caveat: Optional[str] = None
     sources: Optional[List[Source]] = None
+    indicator_check: Optional[IndicatorCheck] = None
 
 
 # ----------------------------
 # App
 # ----------------------------
-app = FastAPI()
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "45"))
+
+# Keys/endpoints to spread calls over (UPSTREAMS, see upstreams.py); without it,
+# just OPENAI_API_KEY. A target's own `model` wins over OPENAI_MODEL.
+upstream_pool = upstreams.Pool(
+    upstreams.targets_from_env(OPENAI_TIMEOUT),
+    attempts=int(os.getenv("UPSTREAM_ATTEMPTS", "2")),
+    eject_after=int(os.getenv("UPSTREAM_EJECT_AFTER", "3")),
+    base_eject_s=float(os.getenv("UPSTREAM_EJECT_SECS", "5")),
+    max_eject_s=float(os.getenv("UPSTREAM_MAX_EJECT_SECS", "300")),
+)
+
+# Optional: open the upstream connection in the background once we're up, so the
+# first /analyze after a spin-down doesn't also pay for TLS + SDK import.
+WARMUP_UPSTREAM = os.getenv("WARMUP_UPSTREAM", "0") == "1"
+
+# Built by `python catalogs.py` at deploy time (see render.yaml).
+CATALOG_PATH = os.getenv("CATALOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), catalogs.DEFAULT_FILENAME))
+
+# Reported phone/account/domain snapshot, built with `python indicators.py build`.
+# Replacing the file is picked up within INDICATORS_RELOAD_SECS, no restart.
+INDICATORS_PATH = os.getenv("INDICATORS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), indicators.DEFAULT_FILENAME))
+# Also have /analyze pull indicators out of the screenshot and look them up.
+INDICATORS_ENRICH = os.getenv("INDICATORS_ENRICH", "0") == "1"
+
+indicator_index = indicators.IndicatorIndex(INDICATORS_PATH, check_every_s=float(os.getenv("INDICATORS_RELOAD_SECS", "30")))
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    if WARMUP_UPSTREAM and upstream_pool.targets and _OPENAI_AVAILABLE:
+        # Daemon thread: never delays the port bind, never blocks shutdown.
+        threading.Thread(target=warm_upstream, name="warm-upstream", daemon=True).start()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Body limits are enforced while the upload streams in, before FastAPI parses it.
+# MAX_B64_CHARS bounds the data URL itself; the body gets a little JSON slack on top.
+MAX_B64_CHARS = int(os.getenv("MAX_B64_CHARS", "3500000"))
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", str(MAX_B64_CHARS + 64 * 1024)))
+# Total image bytes held by in-flight uploads in this process; beyond it, new
+# uploads wait up to INFLIGHT_WAIT_SECS and then get a 503.
+MAX_INFLIGHT_IMAGE_BYTES = int(os.getenv("MAX_INFLIGHT_IMAGE_BYTES", str(4 * MAX_BODY_BYTES)))
+INFLIGHT_WAIT_SECS = float(os.getenv("INFLIGHT_WAIT_SECS", "10"))
+# /export takes a whole pack of screenshots as multipart; the parser spools
+# them to disk, so this bounds disk and upload time rather than memory.
+EXPORT_MAX_FILES = int(os.getenv("EXPORT_MAX_FILES", "20"))
+EXPORT_MAX_BODY_BYTES = int(os.getenv("EXPORT_MAX_BODY_BYTES", str(50 * 1024 * 1024)))
+
+image_budget = InflightBudget(MAX_INFLIGHT_IMAGE_BYTES, INFLIGHT_WAIT_SECS)
+
+# Opt-in request profiling. Needs ADMIN_TOKEN: send `X-Profile: 1` plus
+# `X-Admin-Token`, or set PROFILE_SAMPLE_PCT to profile a random share.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+profile_store = ProfileStore(keep=int(os.getenv("PROFILE_KEEP", "20")), directory=os.getenv("PROFILE_DIR") or None)
+
+# Innermost of ours, so what it samples is the handler rather than our limits.
+app.add_middleware(
+    ProfilingMiddleware,
+    store=profile_store,
+    admin_token=ADMIN_TOKEN,
+    sample_pct=float(os.getenv("PROFILE_SAMPLE_PCT", "0")),
+    interval_ms=float(os.getenv("PROFILE_INTERVAL_MS", "5")),
+)
+
+# A client that disconnects mid-/analyze stops the upstream stream (unless an
+# idempotent retry is waiting on the same result). Innermost but for profiling.
+app.add_middleware(cancel.DisconnectMiddleware, paths=["/analyze"])
+
+# Idempotency-Key on /analyze: mobile clients retry after timeouts, and a replay
+# costs nothing upstream. Inside the body limit, which still bounds its read.
+idempotency_store = idempotency.IdempotencyStore(
+    ttl_s=float(os.getenv("IDEMPOTENCY_TTL_SECS", "3600")),
+    max_keys=int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000")),
+)
+app.add_middleware(
+    idempotency.IdempotencyMiddleware,
+    store=idempotency_store,
+    paths=["/analyze"],
+    wait_s=float(os.getenv("IDEMPOTENCY_WAIT_SECS", str(2 * OPENAI_TIMEOUT + 10))),
+)
+
+# Added before CORS so CORS stays outermost and 413/503s still carry its headers.
+app.add_middleware(
+    BodyLimitMiddleware,
+    max_bytes=MAX_BODY_BYTES,
+    path_limits={"/export": EXPORT_MAX_BODY_BYTES},
+    budget=image_budget,
+    budget_paths=["/analyze"],
+)
+
+# Per-client token buckets ("burst:per_minute", override with RATE_LIMIT_<RULE>).
+# /analyze is what costs upstream quota; the static catalogs are nearly free.
+RATE_LIMIT_RULES = {
+    "analyze": rule_from_env("analyze", Rule(burst=5, per_minute=6)),
+    "static": rule_from_env("static", Rule(burst=60, per_minute=120)),
+    "export": rule_from_env("export", Rule(burst=3, per_minute=3)),
+    "check": rule_from_env("check", Rule(burst=30, per_minute=60)),
+}
+# "ip" (default) or "device": key on X-Device-Token when the client sends one.
+RATE_LIMIT_KEY = os.getenv("RATE_LIMIT_KEY", "ip")
+
+rate_buckets = TokenBuckets(
+    max_keys=int(os.getenv("RATE_LIMIT_MAX_KEYS", "50000")),
+    idle_s=float(os.getenv("RATE_LIMIT_IDLE_SECS", "600")),
+)
+
+
+def rate_limit_rule(path: str) -> Optional[str]:
+    if path == "/analyze":
+        return "analyze"
+    if path == "/export":
+        return "export"
+    if path == "/check":
+        return "check"
+    if path == "/resources" or path.startswith("/plan/"):
+        return "static"
+    return None
+
+
+# Outside the body limit, so a throttled client's upload is never read.
+app.add_middleware(
+    RateLimitMiddleware,
+    buckets=rate_buckets,
+    rules=RATE_LIMIT_RULES,
+    route=rate_limit_rule,
+    use_device_token=RATE_LIMIT_KEY == "device",
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -96,9 +256,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
-OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
-
 
 def today_str() -> str:
     return date.today().isoformat()
@@ -107,10 +264,10 @@ def today_str() -> str:
 # ----------------------------
 # Official Malaysia sources (curated)
 # ----------------------------
-def official_sources() -> List[Source]:
+def official_sources(d: Optional[str] = None) -> List[Source]:
     # Keep URLs official / authoritative.
     # (You can expand this list anytime.)
-    d = today_str()
+    d = d or today_str()
     return [
         Source(
             id="NFCC_NSRC_997",
@@ -284,6 +441,13 @@ CONTENT RULES:
   - Automated, pattern-based triage; not official diagnosis; may be wrong.
   - If money moved: contact your bank + NSRC 997 immediately.
   - Encourage verification via official lists (SC/BNM).
+""" + (INDICATORS_PROMPT if INDICATORS_ENRICH else "")
+
+
+INDICATORS_PROMPT = """
+INDICATORS (server-side lookup only):
+- The one exception to rule 2: copy every phone number, bank account number and URL/domain visible in the screenshot, exactly as shown, into "indicators": { "phones": [string], "accounts": [string], "urls": [string] }.
+- This field is removed before anything is shown or stored. Never repeat these values in any other field.
 """
 
 
@@ -367,32 +531,265 @@ def ensure_minimum_fields(obj: Dict[str, Any], sources: List[Source]) -> Dict[st
     return obj
 
 
-def openai_client():
-    if OpenAI is None:
-        raise RuntimeError("openai package not available")
-    if not OPENAI_API_KEY:
-        raise RuntimeError("OPENAI_API_KEY not set")
-    return OpenAI(api_key=OPENAI_API_KEY)
-
-
 # ----------------------------
-# Routes
+# Structured output
 # ----------------------------
-@app.get("/version")
-def version():
-    return {
-        "ok": True,
-        "has_key": bool(OPENAI_API_KEY),
-        "model": OPENAI_MODEL,
-        "date": today_str(),
-    }
+# "json_schema" (default) constrains generation to the VerifyResult contract, so
+# the repair passes above become a safety net instead of the main path.
+# "json_object" / "none" keep the older behaviour for models without it.
+OPENAI_RESPONSE_FORMAT = os.getenv("OPENAI_RESPONSE_FORMAT", "json_schema")
 
+# Output budget per language. The model no longer writes `sources` (filled in
+# server-side), which is most of what the old flat 1200 paid for. Tamil costs
+# several times more tokens per character than the other languages.
+ANALYZE_MAX_TOKENS: Dict[str, int] = {"EN": 900, "MS": 1000, "ZH": 1000, "TA": 1800}
+if os.getenv("ANALYZE_MAX_TOKENS"):
+    ANALYZE_MAX_TOKENS = {k: int(os.environ["ANALYZE_MAX_TOKENS"]) for k in ANALYZE_MAX_TOKENS}
 
-@app.get("/resources")
-def resources():
+
+class AnalysisFailed(Exception):
+    """
+    The model's output was still unusable after the re-ask.
+    """
+
+
+def _strict(node: Any, in_properties: bool = False) -> Any:
+    # OpenAI strict mode: every property required, no extras, no defaults.
+    if isinstance(node, list):
+        return [_strict(x) for x in node]
+    if not isinstance(node, dict):
+        return node
+    if in_properties:
+        return {k: _strict(v) for k, v in node.items()}
+    out = {k: _strict(v, in_properties=(k in ("properties", "$defs"))) for k, v in node.items() if k not in ("default", "title")}
+    if out.get("type") == "object" and "properties" in out:
+        out["required"] = list(out["properties"])
+        out["additionalProperties"] = False
+    return out
+
+
+_output_schema: Optional[Dict[str, Any]] = None
+
+def model_output_schema() -> Dict[str, Any]:
+    """
+    JSON schema the model must produce, derived from VerifyResult.
+    `sources` is left out (always overwritten by ensure_minimum_fields) and
+    source_ids are pinned to our official source IDs.
+    """
+    global _output_schema
+    if _output_schema is None:
+        schema = VerifyResult.model_json_schema()
+        schema["properties"].pop("sources", None)
+        schema["$defs"].pop("Source", None)
+        schema["properties"].pop("indicator_check", None)
+        schema["$defs"].pop("IndicatorCheck", None)
+        ids = [s.id for s in official_sources()]
+        for name in ("Action", "Contact"):
+            for option in schema["$defs"][name]["properties"]["source_ids"]["anyOf"]:
+                if option.get("type") == "array":
+                    option["items"] = {"type": "string", "enum": ids}
+        if INDICATORS_ENRICH:
+            lst = {"type": "array", "items": {"type": "string"}}
+            schema["properties"]["indicators"] = {
+                "type": "object",
+                "properties": {"phones": lst, "accounts": lst, "urls": lst},
+            }
+        _output_schema = _strict(schema)
+    return _output_schema
+
+
+def response_format(mode: str) -> Optional[Dict[str, Any]]:
+    if mode == "json_schema":
+        return {
+            "type": "json_schema",
+            "json_schema": {"name": "verify_result", "strict": True, "schema": model_output_schema()},
+        }
+    if mode == "json_object":
+        return {"type": "json_object"}
+    return None
+
+
+def parse_result(text: str, sources: List[Source]):
+    """
+    Model text -> (validated result, raw indicators). The indicators never
+    reach the result.
+    """
+    obj = extract_json(text)
+    found = obj.pop("indicators", None)
+    obj.pop("indicator_check", None)
+    obj = ensure_minimum_fields(obj, sources)
+    # Validate structure
+    return VerifyResult(**obj).model_dump(exclude_none=True), found if isinstance(found, dict) else {}
+
+
+def reask_messages(messages: List[Dict[str, Any]], bad: str, error: Exception, truncated: bool) -> List[Dict[str, Any]]:
+    """
+    One targeted follow-up: the bad reply plus what was wrong with it. The
+    screenshot is not re-sent; the analysis is already in the reply.
+    """
+    if truncated:
+        fix = "Your reply was cut off before the JSON was complete. Reply again with the complete JSON only, using shorter text in each field."
+    else:
+        fix = f"Your reply did not match the required JSON schema ({str(error)[:300]}). Reply again with the corrected JSON only."
+    user_text = next(p["text"] for p in messages[1]["content"] if p.get("type") == "text")
+    return [
+        messages[0],
+        {"role": "user", "content": user_text},
+        {"role": "assistant", "content": bad},
+        {"role": "user", "content": fix},
+    ]
+
+
+def complete(
+    messages: List[Dict[str, Any]],
+    model: Optional[str],
+    max_tokens: int,
+    fmt: Optional[Dict[str, Any]],
+    pool: Optional[upstreams.Pool] = None,
+):
+    """
+    One upstream call -> (text, finish_reason, usage), on whichever target of
+    `pool` (default: upstream_pool) is best right now, another one if that fails.
+
+    Inside a request with a CancelToken the call streams, so it can be
+    abandoned between chunks once the client is gone (raises cancel.Cancelled).
+    """
+    token = cancel.current()
+    if token is not None and token.cancelled:
+        metrics.incr("cancel.skipped_calls")
+        metrics.incr("cancel.saved_prompt_tokens_est", _avg("upstream.prompt_tokens"))
+        metrics.incr("cancel.saved_completion_tokens_est", _avg("upstream.completion_tokens"))
+        raise cancel.Cancelled()
+
+    kwargs: Dict[str, Any] = {"temperature": 0.2, "max_tokens": max_tokens, "messages": messages}
+    if fmt:
+        kwargs["response_format"] = fmt
+
+    def call(target: upstreams.Target):
+        kw = dict(kwargs, model=model or target.model or OPENAI_MODEL)
+        if token is None:
+            resp = target.client().chat.completions.create(**kw)
+            usage = {
+                "prompt_tokens": getattr(resp.usage, "prompt_tokens", 0) or 0,
+                "completion_tokens": getattr(resp.usage, "completion_tokens", 0) or 0,
+            }
+            choice = resp.choices[0]
+            text, finish = choice.message.content or "", choice.finish_reason
+        else:
+            text, finish, usage = _complete_streaming(target.client(), kw, token)
+        pool.record_tokens(target, usage["prompt_tokens"], usage["completion_tokens"])
+        return text, finish, usage
+
+    pool = pool or upstream_pool
+    text, finish, usage = pool.call(call)
+    metrics.incr("upstream.calls")
+    metrics.incr("upstream.prompt_tokens", usage["prompt_tokens"])
+    metrics.incr("upstream.completion_tokens", usage["completion_tokens"])
+    idempotency.record_usage(usage["prompt_tokens"], usage["completion_tokens"])
+    return text.strip(), finish, usage
+
+
+def _avg(counter: str) -> float:
+    return round(metrics.ratio(metrics.get(counter), metrics.get("upstream.calls")))
+
+
+def _complete_streaming(client, kwargs: Dict[str, Any], token: cancel.CancelToken):
+    parts: List[str] = []
+    finish = None
+    usage = {"prompt_tokens": 0, "completion_tokens": 0}
+    stream = client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+    with stream:
+        for chunk in stream:
+            if token.cancelled:
+                # Leaving the with-block closes the connection; generation stops
+                # upstream and only what was produced so far is billed.
+                generated = len(parts)  # ~1 token per content chunk
+                metrics.incr("cancel.aborted_calls")
+                metrics.incr("cancel.saved_completion_tokens_est", max(0, _avg("upstream.completion_tokens") - generated))
+                idempotency.record_usage(0, generated)
+                raise cancel.Cancelled()
+            if chunk.usage:
+                usage["prompt_tokens"] = chunk.usage.prompt_tokens or 0
+                usage["completion_tokens"] = chunk.usage.completion_tokens or 0
+            for choice in chunk.choices:
+                if choice.delta and choice.delta.content:
+                    parts.append(choice.delta.content)
+                if choice.finish_reason:
+                    finish = choice.finish_reason
+    return "".join(parts), finish, usage
+
+
+def run_analysis(
+    img: str,
+    lang: Lang,
+    model: Optional[str] = None,
+    system: Optional[str] = None,
+    fmt_mode: Optional[str] = None,
+    pool: Optional[upstreams.Pool] = None,
+) -> Dict[str, Any]:
+    """
+    Screenshot -> validated VerifyResult dict, with at most one re-ask.
+    Returns {"result": ..., "indicators": {...}, "usage": {...}, "attempts": n,
+    "wasted_completion_tokens": n}.
+    """
+    srcs = official_sources()
+    fmt = response_format(fmt_mode or OPENAI_RESPONSE_FORMAT)
+    messages = [
+        {"role": "system", "content": system or system_prompt()},
+        {
+            "role": "user",
+            # Vision input: attach image to the user message
+            "content": [
+                {"type": "text", "text": build_user_prompt(lang)},
+                {"type": "image_url", "image_url": {"url": img}},
+            ],
+        },
+    ]
+    usage = {"prompt_tokens": 0, "completion_tokens": 0}
+    max_tokens = ANALYZE_MAX_TOKENS.get(lang, ANALYZE_MAX_TOKENS["EN"])
+    wasted = 0
+
+    for attempt in (1, 2):
+        text, finish, u = complete(messages, model, max_tokens, fmt, pool)
+        usage["prompt_tokens"] += u["prompt_tokens"]
+        usage["completion_tokens"] += u["completion_tokens"]
+        try:
+            result, found = parse_result(text, srcs)
+        except Exception as e:
+            metrics.incr("output.malformed")
+            metrics.incr("output.wasted_completion_tokens", u["completion_tokens"])
+            wasted += u["completion_tokens"]
+            if attempt == 2:
+                raise AnalysisFailed(str(e)[:300]) from e
+            metrics.incr("output.reask")
+            messages = reask_messages(messages, text, e, truncated=(finish == "length"))
+            continue
+        if attempt == 2:
+            metrics.incr("output.reask_ok")
+        return {"result": result, "indicators": found, "usage": usage, "attempts": attempt, "wasted_completion_tokens": wasted}
+
+    raise AssertionError("unreachable")
+
+
+def warm_upstream() -> None:
+    """
+    Import the SDK and open a pooled connection to each target with one cheap
+    call. Best effort: failures only mean the first /analyze does the work instead.
+    """
+    for target in upstream_pool.targets:
+        try:
+            target.client().models.retrieve(target.model or OPENAI_MODEL)
+        except Exception as e:
+            log.warning("upstream warm-up failed for %s: %s", target.name, e)
+
+
+# ----------------------------
+# Static catalogs (/resources, /plan)
+# ----------------------------
+def resources_payload(d: str) -> Dict[str, Any]:
     # You already designed a beautiful resources UI.
     # This endpoint provides the structured list.
-    srcs = official_sources()
+    srcs = official_sources(d)
 
     categories = [
         {
@@ -421,15 +818,10 @@ def resources():
         },
     ]
 
-    return {"result": {"last_verified": today_str(), "categories": categories}}
+    return {"result": {"last_verified": d, "categories": categories}}
 
 
-@app.get("/plan/{scenario}")
-def plan(scenario: str):
-    """
-    Lightweight plan endpoint used by your Toolkit scenario pages.
-    This stays non-identifying and Malaysia-first.
-    """
+def normalize_scenario(scenario: str) -> Scenario:
     s = scenario.strip().lower()
     scenario_norm: Scenario = "other"  # default
     allowed = {
@@ -445,8 +837,21 @@ def plan(scenario: str):
     }
     if s in allowed:
         scenario_norm = allowed[s]
+    return scenario_norm
 
-    srcs = official_sources()
+
+def normalize_lang(lang: str) -> Lang:
+    # Lenient on purpose: an unknown language gets English, not a 422.
+    l = (lang or "").strip().upper()
+    return l if l in Lang.__args__ else "EN"
+
+
+def plan_payload(scenario_norm: Scenario, d: str) -> Dict[str, Any]:
+    """
+    Lightweight plan used by your Toolkit scenario pages.
+    This stays non-identifying and Malaysia-first.
+    """
+    srcs = official_sources(d)
     smap = sources_map(srcs)
 
     # Minimal per-scenario “When:” text
@@ -613,50 +1018,226 @@ def plan(scenario: str):
     return {"result": result}
 
 
+def build_catalog_entries() -> Dict[str, Any]:
+    """
+    Every static response in every language, keyed for catalogs.Catalog
+    ("resources/<lang>", "plan/<scenario>/<lang>"). Dates are left as
+    catalogs.DATE_TOKEN and filled in per request.
+    """
+    d = catalogs.DATE_TOKEN
+    english: Dict[str, Any] = {"resources": resources_payload(d)}
+    for scenario in Scenario.__args__:
+        english[f"plan/{scenario}"] = plan_payload(scenario, d)
+
+    entries: Dict[str, Any] = {}
+    for lang in Lang.__args__:
+        table = catalogs.load_translations(lang)
+        for key, payload in english.items():
+            entries[f"{key}/{lang}"] = catalogs.translate(payload, table)
+    return entries
+
+
+_catalog: Optional[catalogs.Catalog] = None
+
+def catalog() -> catalogs.Catalog:
+    # Prebuilt file when deployed; built in-process (once) when running locally.
+    global _catalog
+    if _catalog is None:
+        _catalog = catalogs.Catalog.load(CATALOG_PATH) or catalogs.Catalog.from_entries(build_catalog_entries())
+    return _catalog
+
+
+def catalog_response(key: str) -> Response:
+    return Response(content=catalog().render(key, today_str()), media_type="application/json")
+
+
+# ----------------------------
+# Routes
+# ----------------------------
+@app.get("/version")
+def version():
+    return {
+        "ok": True,
+        "has_key": bool(upstream_pool.targets),
+        "upstreams": len(upstream_pool.targets),
+        "model": OPENAI_MODEL,
+        "date": today_str(),
+    }
+
+@app.get("/metrics")
+def metrics_view():
+    c = metrics.snapshot()
+    return {
+        "counters": c,
+        "derived": {
+            "malformed_rate": metrics.ratio(c.get("output.malformed", 0), c.get("upstream.calls", 0)),
+            "reask_recovery_rate": metrics.ratio(c.get("output.reask_ok", 0), c.get("output.reask", 0)),
+            "wasted_completion_tokens_per_success": metrics.ratio(c.get("output.wasted_completion_tokens", 0), c.get("analyze.ok", 0)),
+        },
+        "rate_limit": rate_buckets.stats(),
+        "image_budget": image_budget.stats(),
+        "indicators": indicator_index.stats(),
+        "idempotency": idempotency_store.stats(),
+        "upstreams": upstream_pool.stats(),
+    }
+
+
+def require_admin(request: Request) -> None:
+    if not is_admin(request.scope.get("headers", ()), ADMIN_TOKEN):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+@app.get("/debug/profiles")
+def list_profiles(request: Request):
+    require_admin(request)
+    return {"result": profile_store.list()}
+
+
+@app.get("/debug/profiles/{pid}")
+def get_profile(pid: str, request: Request):
+    require_admin(request)
+    prof = profile_store.get(pid)
+    if prof is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    # Folded stacks: `flamegraph.pl`, speedscope and inferno read this directly.
+    return Response(content=prof.folded(), media_type="text/plain")
+
+
+@app.get("/healthz")
+def healthz():
+    # Must stay cheap: Render probes this, and it's the first thing hit after a spin-down.
+    return {"ok": True}
+
+
+@app.get("/resources")
+@profiled
+def resources(lang: str = "EN"):
+    return catalog_response(f"resources/{normalize_lang(lang)}")
+
+
+@app.get("/plan/{scenario}")
+@profiled
+def plan(scenario: str, lang: str = "EN"):
+    return catalog_response(f"plan/{normalize_scenario(scenario)}/{normalize_lang(lang)}")
+
+
 @app.post("/analyze")
+@profiled
 def analyze(payload: AnalyzeIn):
-    if not OPENAI_API_KEY:
-        raise HTTPException(status_code=500, detail="OPENAI_API_KEY is not configured")
+    if not upstream_pool.targets:
+        raise HTTPException(status_code=500, detail="OPENAI_API_KEY (or UPSTREAMS) is not configured")
 
-    if OpenAI is None:
+    if not _OPENAI_AVAILABLE:
         raise HTTPException(status_code=500, detail="openai package not installed")
 
     img = payload.image_data_url
     if not img.startswith("data:image/"):
         raise HTTPException(status_code=400, detail="image_data_url must be a data:image/... base64 URL")
+    if len(img) > MAX_B64_CHARS:
+        raise HTTPException(status_code=413, detail="Image too large. Please use a smaller screenshot.")
 
-    srcs = official_sources()
-
-    client = openai_client()
-
+    metrics.incr("analyze.requests")
     try:
-        # Vision input: attach image to the user message
-        resp = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            temperature=0.2,
-            max_tokens=1200,
-            messages=[
-                {"role": "system", "content": system_prompt()},
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": build_user_prompt(payload.lang)},
-                        {"type": "image_url", "image_url": {"url": img}},
-                    ],
-                },
-            ],
+        out = run_analysis(img, payload.lang)
+        metrics.incr("analyze.ok")
+        if INDICATORS_ENRICH:
+            summary = check_indicators(out["indicators"])
+            if summary:
+                out["result"]["indicator_check"] = summary
+        return {"result": out["result"]}
+
+    except cancel.Cancelled:
+        metrics.incr("analyze.cancelled")
+        raise HTTPException(status_code=cancel.CLIENT_CLOSED, detail="Client closed request")
+    except upstreams.Unavailable as e:
+        metrics.incr("analyze.failed")
+        raise HTTPException(
+            status_code=503,
+            detail="The analysis service is busy. Please try again shortly.",
+            headers={"Retry-After": str(e.retry_after_s)},
         )
-
-        text = (resp.choices[0].message.content or "").strip()
-        obj = extract_json(text)
-        obj = ensure_minimum_fields(obj, srcs)
-
-        # Validate structure
-        result = VerifyResult(**obj).model_dump()
-
-        return {"result": result}
-
+    except AnalysisFailed as e:
+        metrics.incr("analyze.failed")
+        raise HTTPException(status_code=502, detail=f"Model returned unusable output: {e}")
     except HTTPException:
         raise
     except Exception as e:
+        metrics.incr("analyze.failed")
         raise HTTPException(status_code=500, detail=f"Analyze failed: {str(e)}")
+
+
+# ----------------------------
+# Indicator lookup
+# ----------------------------
+_FOUND_KINDS = {"phones": "phone", "accounts": "account", "urls": "url"}
+
+def check_indicators(found: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Look up what the model extracted; only counts leave this function, so the
+    response never carries the values themselves.
+    """
+    if indicator_index.snapshot() is None:
+        return None
+    results = []
+    for field, kind in _FOUND_KINDS.items():
+        values = found.get(field)
+        if isinstance(values, list):
+            results += [indicator_index.lookup(kind, str(v)) for v in values[:10]]
+    results = [r for r in results if r["normalized"]]
+    if not results:
+        return None
+    matched = [r for r in results if r["match"]]
+    metrics.incr("indicators.lookups", len(results))
+    metrics.incr("indicators.matches", len(matched))
+    return {"checked": len(results), "matched": len(matched), "matched_types": sorted({r["type"] for r in matched})}
+
+
+@app.post("/check")
+@profiled
+def check(payload: CheckIn):
+    snap = indicator_index.snapshot()
+    if snap is None:
+        raise HTTPException(status_code=503, detail="Indicator list is not loaded")
+    results = [indicator_index.lookup(it.type, it.value) for it in payload.items]
+    metrics.incr("indicators.lookups", len(results))
+    metrics.incr("indicators.matches", sum(1 for r in results if r["match"]))
+    return {"results": results, "snapshot": snap.info()}
+
+
+@app.post("/export")
+async def export(request: Request):
+    """
+    Multipart form: `result` (the /analyze result as JSON), `images` (one or
+    more screenshots) and an optional `note`. Streams back a ZIP evidence pack.
+    """
+    form = await request.form(max_files=EXPORT_MAX_FILES, max_fields=10)
+    try:
+        try:
+            result = VerifyResult.model_validate_json(form.get("result") or "").model_dump(exclude_none=True)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="result must be the JSON result returned by /analyze")
+        images = [f for f in form.getlist("images") if not isinstance(f, str)]
+        if not images:
+            raise HTTPException(status_code=400, detail="Attach at least one screenshot as images")
+        for f in images:
+            if not (f.content_type or "").startswith("image/"):
+                raise HTTPException(status_code=400, detail=f"{f.filename or 'file'} is not an image")
+        note = str(form.get("note") or "")[:2000]
+    except BaseException:
+        await form.close()
+        raise
+
+    async def body():
+        try:
+            async for chunk in evidence.stream_pack(result, images, note):
+                yield chunk
+        finally:
+            await form.close()
+
+    metrics.incr("export.requests")
+    name = "waspada-evidence-" + date.today().isoformat() + ".zip"
+    return StreamingResponse(
+        body(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{name}"', "Cache-Control": "no-store"},
+    )
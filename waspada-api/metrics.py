@@ -0,0 +1,31 @@
+"""
+Process-local counters, served by /metrics.
+
+Handlers run in the threadpool, so increments take a lock; they're rare
+(a handful per upstream call), so it never shows up in latency.
+"""
+import threading
+from collections import defaultdict
+from typing import Dict
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = defaultdict(int)
+
+
+def incr(name: str, n: float = 1) -> None:
+    with _lock:
+        _counters[name] += n
+
+
+def get(name: str) -> float:
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot() -> Dict[str, float]:
+    with _lock:
+        return dict(sorted(_counters.items()))
+
+
+def ratio(num: float, den: float) -> float:
+    return round(num / den, 4) if den else 0.0
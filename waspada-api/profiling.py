@@ -0,0 +1,217 @@
+"""
+On-demand sampling profiler for single requests.
+
+A request is profiled when it carries `X-Profile: 1` together with a valid
+`X-Admin-Token`, or when it falls into the PROFILE_SAMPLE_PCT random sample.
+While it runs, a sampler thread snapshots the stacks of the threads working on
+it (the event loop and the threadpool worker running the handler) every few
+milliseconds. The result is stored in "folded" format (`a;b;c 42` per line),
+ready for flamegraph.pl, speedscope or inferno.
+
+When nothing is being profiled, the cost is one header scan in the middleware
+and one ContextVar lookup per decorated handler.
+"""
+import asyncio
+import contextvars
+import functools
+import hmac
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Dict, List, Optional
+
+# Inclusive sample counts per phase: a sample counts towards a phase when any
+# frame in its stack contains one of these "module:function" fragments.
+PHASES = {
+    "handler": ("main:analyze", "main:plan", "main:resources", "main:check"),
+    "upstream": ("main:complete",),
+    "validation": ("main:parse_result", "pydantic."),
+    "redaction": ("main:redact_",),
+    "serialization": ("json.encoder:", "fastapi.encoders:", "starlette.responses:render"),
+}
+
+_active: contextvars.ContextVar[Optional["Profile"]] = contextvars.ContextVar("waspada_profile", default=None)
+_ids = itertools.count(1)
+
+
+class Profile:
+    def __init__(self, method: str, path: str, interval_s: float, reason: str):
+        self.id = f"{int(time.time())}-{next(_ids)}"
+        self.method = method
+        self.path = path
+        self.reason = reason
+        self.interval_s = interval_s
+        self.started = time.time()
+        self.duration_ms = 0.0
+        self.status: Optional[int] = None
+        self.samples: Counter = Counter()
+        self._threads: Dict[int, str] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"profile-{self.id}", daemon=True)
+
+    def add_thread(self, ident: int, label: str) -> None:
+        self._threads[ident] = label
+
+    def remove_thread(self, ident: int) -> None:
+        self._threads.pop(ident, None)
+
+    def start(self) -> None:
+        self._t0 = time.perf_counter()
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.duration_ms = round((time.perf_counter() - self._t0) * 1000, 2)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            frames = sys._current_frames()
+            for ident, label in list(self._threads.items()):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = _fold(frame)
+                if stack is not None:
+                    self.samples[label + ";" + stack] += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in self.samples.most_common())
+
+    def summary(self) -> Dict[str, Any]:
+        total = sum(self.samples.values())
+        phases = {}
+        for phase, names in PHASES.items():
+            hits = sum(n for stack, n in self.samples.items() if any(frag in stack for frag in names))
+            phases[phase] = {"samples": hits, "ms": round(hits * self.interval_s * 1000, 1)}
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "reason": self.reason,
+            "started": self.started,
+            "duration_ms": self.duration_ms,
+            "interval_ms": self.interval_s * 1000,
+            "samples": total,
+            "phases": phases,
+        }
+
+
+def _fold(frame) -> Optional[str]:
+    parts: List[str] = []
+    f = frame
+    while f is not None and len(parts) < 128:
+        code = f.f_code
+        parts.append(f"{f.f_globals.get('__name__', '?')}:{code.co_name}")
+        f = f.f_back
+    # An idle event loop sits in selectors.select(); that's not request time.
+    if parts and parts[0].startswith("selectors:"):
+        return None
+    parts.reverse()
+    return ";".join(parts)
+
+
+def profiled(fn):
+    """
+    Decorate route handlers so the worker thread running them is sampled when
+    the request is being profiled.
+    """
+    if asyncio.iscoroutinefunction(fn):
+        return fn  # runs on the event loop, which is always sampled
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        prof = _active.get()
+        if prof is None:
+            return fn(*args, **kwargs)
+        ident = threading.get_ident()
+        prof.add_thread(ident, "worker")
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            prof.remove_thread(ident)
+
+    return wrapper
+
+
+class ProfileStore:
+    def __init__(self, keep: int = 20, directory: Optional[str] = None):
+        self._profiles: deque = deque(maxlen=keep)
+        self.directory = directory
+
+    def add(self, prof: Profile) -> None:
+        self._profiles.append(prof)
+        if self.directory:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(os.path.join(self.directory, prof.id + ".folded"), "w", encoding="utf-8") as f:
+                    f.write(prof.folded())
+            except OSError:
+                pass
+
+    def list(self) -> List[Dict[str, Any]]:
+        return [p.summary() for p in reversed(self._profiles)]
+
+    def get(self, pid: str) -> Optional[Profile]:
+        for p in self._profiles:
+            if p.id == pid:
+                return p
+        return None
+
+
+def is_admin(headers, admin_token: str) -> bool:
+    if not admin_token:
+        return False
+    for k, v in headers:
+        if k == b"x-admin-token":
+            return hmac.compare_digest(v.decode("latin-1"), admin_token)
+    return False
+
+
+class ProfilingMiddleware:
+    def __init__(self, app, store: ProfileStore, admin_token: str = "", sample_pct: float = 0.0, interval_ms: float = 5.0):
+        self.app = app
+        self.store = store
+        self.admin_token = admin_token
+        self.sample = sample_pct / 100.0
+        self.interval_s = interval_ms / 1000.0
+
+    def _reason(self, scope) -> Optional[str]:
+        headers = scope.get("headers", ())
+        if self.admin_token:
+            for k, v in headers:
+                if k == b"x-profile" and v == b"1":
+                    return "header" if is_admin(headers, self.admin_token) else None
+        if self.sample and random.random() < self.sample:
+            return "sample"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("path", "").startswith("/debug/"):
+            return await self.app(scope, receive, send)
+        reason = self._reason(scope)
+        if reason is None:
+            return await self.app(scope, receive, send)
+
+        prof = Profile(scope.get("method", ""), scope.get("path", ""), self.interval_s, reason)
+        prof.add_thread(threading.get_ident(), "loop")
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                prof.status = message["status"]
+                message["headers"] = list(message.get("headers", ())) + [(b"x-profile-id", prof.id.encode())]
+            await send(message)
+
+        token = _active.set(prof)
+        prof.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _active.reset(token)
+            prof.stop()
+            self.store.add(prof)
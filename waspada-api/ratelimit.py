@@ -0,0 +1,161 @@
+"""
+In-process, per-client token-bucket rate limiting (pure ASGI).
+
+Each (rule, client) pair gets a bucket of `burst` tokens refilled at
+`per_minute / 60` tokens per second. Buckets live in one OrderedDict kept in
+least-recently-used order, so eviction of idle or excess keys only ever looks at
+the front: memory is bounded by `max_keys` and a hit is a couple of dict
+operations. Everything runs on the event loop, so no locks.
+
+Responses carry the IETF RateLimit header fields (RateLimit-Limit,
+RateLimit-Remaining, RateLimit-Reset, RateLimit-Policy); a 429 also carries
+Retry-After.
+"""
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+
+class Rule(NamedTuple):
+    burst: int
+    per_minute: float
+
+    @property
+    def per_second(self) -> float:
+        return self.per_minute / 60.0
+
+
+class Decision(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    reset_s: int  # until the bucket is full again
+    retry_after_s: int  # until the next token (0 when allowed)
+
+
+def rule_from_env(name: str, default: Rule) -> Rule:
+    """
+    RATE_LIMIT_<NAME>="burst:per_minute", e.g. RATE_LIMIT_ANALYZE="5:6".
+    """
+    raw = os.getenv(f"RATE_LIMIT_{name.upper()}", "").strip()
+    if not raw:
+        return default
+    burst, _, per_minute = raw.partition(":")
+    return Rule(int(burst), float(per_minute or burst))
+
+
+class TokenBuckets:
+    def __init__(self, max_keys: int = 50_000, idle_s: float = 600.0, clock: Callable[[], float] = time.monotonic):
+        self.max_keys = max_keys
+        self.idle_s = idle_s
+        self.clock = clock
+        self._buckets: "OrderedDict[Tuple[str, str], list]" = OrderedDict()
+        self.rejected: Dict[str, int] = {}
+
+    def hit(self, rule_name: str, rule: Rule, client: str) -> Decision:
+        now = self.clock()
+        key = (rule_name, client)
+        b = self._buckets.get(key)
+        if b is None:
+            b = [float(rule.burst), now]
+            self._buckets[key] = b
+            self._evict(now)
+        else:
+            self._buckets.move_to_end(key)
+            b[0] = min(float(rule.burst), b[0] + (now - b[1]) * rule.per_second)
+            b[1] = now
+
+        allowed = b[0] >= 1.0
+        if allowed:
+            b[0] -= 1.0
+        else:
+            self.rejected[rule_name] = self.rejected.get(rule_name, 0) + 1
+
+        rate = rule.per_second or 1e-9
+        reset_s = math.ceil((rule.burst - b[0]) / rate)
+        retry_after_s = 0 if allowed else math.ceil((1.0 - b[0]) / rate)
+        return Decision(allowed, rule.burst, int(b[0]), reset_s, retry_after_s)
+
+    def _evict(self, now: float) -> None:
+        buckets = self._buckets
+        while len(buckets) > self.max_keys:
+            buckets.popitem(last=False)
+        # Front of the dict is the least recently used key.
+        while buckets:
+            first = next(iter(buckets.values()))
+            if now - first[1] < self.idle_s:
+                break
+            buckets.popitem(last=False)
+
+    def stats(self) -> Dict[str, object]:
+        return {"keys": len(self._buckets), "rejected": dict(self.rejected)}
+
+
+def client_key(scope, use_device_token: bool, trust_proxy: bool) -> str:
+    device = xff = None
+    for k, v in scope.get("headers", ()):
+        if k == b"x-device-token":
+            device = v
+        elif k == b"x-forwarded-for":
+            xff = v
+    if use_device_token and device:
+        return "d:" + device[:128].decode("latin-1")
+    if trust_proxy and xff:
+        return "ip:" + xff.split(b",", 1)[0].strip().decode("latin-1")
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown")
+
+
+class RateLimitMiddleware:
+    def __init__(
+        self,
+        app,
+        buckets: TokenBuckets,
+        rules: Dict[str, Rule],
+        route: Callable[[str], Optional[str]],
+        use_device_token: bool = False,
+        trust_proxy: bool = True,
+    ):
+        self.app = app
+        self.buckets = buckets
+        self.rules = rules
+        self.route = route
+        self.use_device_token = use_device_token
+        self.trust_proxy = trust_proxy
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("method") == "OPTIONS":
+            return await self.app(scope, receive, send)
+        name = self.route(scope.get("path", ""))
+        rule = self.rules.get(name) if name else None
+        if rule is None:
+            return await self.app(scope, receive, send)
+
+        d = self.buckets.hit(name, rule, client_key(scope, self.use_device_token, self.trust_proxy))
+        headers = [
+            (b"ratelimit-limit", str(d.limit).encode()),
+            (b"ratelimit-remaining", str(d.remaining).encode()),
+            (b"ratelimit-reset", str(d.reset_s).encode()),
+            (b"ratelimit-policy", f"{rule.burst};w={math.ceil(rule.burst / (rule.per_second or 1e-9))}".encode()),
+        ]
+
+        if not d.allowed:
+            body = json.dumps({"detail": "Too many requests. Please wait a moment and try again."}).encode("utf-8")
+            headers += [
+                (b"retry-after", str(d.retry_after_s).encode()),
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+            ]
+            await send({"type": "http.response.start", "status": 429, "headers": headers})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", ())) + headers
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
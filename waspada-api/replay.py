@@ -0,0 +1,395 @@
+"""
+Offline replay: run recorded /analyze requests through the real pipeline
+(run_analysis: prompt, structured output, re-ask, repair, redaction,
+validation) under several model / prompt configs, and compare them.
+
+    python replay.py RECORDS CONFIGS [-j 4] [--repeat 1] [--responses DIR [--record]] [--json OUT]
+
+RECORDS    directory, one request per file: <id>.json with the /analyze body
+           ({"image_data_url", "lang"}) plus optional human labels
+           "expected": {"verdict", "risk", "scenario"}; or a bare screenshot
+           <id>.png / .jpg / .jpeg / .webp (lang EN).
+CONFIGS    JSON list of {"name", "model", "system_prompt_file",
+           "response_format", "base_url", "api_key" | "api_key_env",
+           "usd_per_mtok_in", "usd_per_mtok_out", "baseline"}; everything but
+           name is optional. The first config, or the one marked
+           "baseline": true, is what the others are compared against.
+
+Upstream is live by default: the config's own base_url/key, otherwise the
+service's UPSTREAMS / OPENAI_API_KEY (point either at stub_upstream.py for a
+local stand-in). With --responses DIR the upstream replies come from
+DIR/<config>/<id>.json instead, with their recorded latency, and nothing goes
+over the network; add --record to a live run to write those files.
+
+Per config it reports latency p50/p90/p99, tokens (and cost, given prices),
+schema-failure rate, and verdict/risk/scenario agreement with the baseline and
+with the labels, plus how often risk came out lower than the baseline's.
+Repeats add verdict stability. It ends with the cheapest config, then the
+fastest, that stays within --min-agreement of the baseline.
+"""
+import argparse
+import base64
+import json
+import math
+import mimetypes
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import upstreams
+
+FIELDS = ("verdict", "risk", "scenario")
+RISK_RANK = {"LOW": 0, "MEDIUM": 1, "HIGH": 2}
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp")
+
+# Upstream replies seen by the job running on this thread.
+_job = threading.local()
+
+
+# ----------------------------
+# Inputs
+# ----------------------------
+def load_records(directory: str) -> List[Dict[str, Any]]:
+    records = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        rid, ext = os.path.splitext(name)
+        if ext == ".json":
+            with open(path, "r", encoding="utf-8") as f:
+                body = json.load(f)
+            records.append({
+                "id": rid,
+                "image_data_url": body["image_data_url"],
+                "lang": body.get("lang", "EN"),
+                "expected": body.get("expected") or {},
+            })
+        elif ext.lower() in IMAGE_EXTS:
+            mime = mimetypes.guess_type(name)[0] or "image/png"
+            with open(path, "rb") as f:
+                data = base64.b64encode(f.read()).decode("ascii")
+            records.append({"id": rid, "image_data_url": f"data:{mime};base64,{data}", "lang": "EN", "expected": {}})
+    return records
+
+
+def load_configs(path: str) -> List[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        configs = json.load(f)
+    here = os.path.dirname(os.path.abspath(path))
+    for cfg in configs:
+        prompt_file = cfg.get("system_prompt_file")
+        if prompt_file:
+            with open(os.path.join(here, prompt_file), "r", encoding="utf-8") as f:
+                cfg["system"] = f.read()
+    if not any(c.get("baseline") for c in configs):
+        configs[0]["baseline"] = True
+    return configs
+
+
+# ----------------------------
+# Upstream taps
+# ----------------------------
+def _log(text: str, finish: Optional[str], usage: Dict[str, int], latency_ms: float) -> None:
+    _job.log.append({"text": text, "finish_reason": finish, "usage": usage, "latency_ms": round(latency_ms, 1)})
+
+
+class _Tap:
+    """
+    Client wrapper that logs every live reply for the current job.
+    """
+
+    def __init__(self, inner):
+        self._inner = inner
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, **kwargs):
+        t0 = time.perf_counter()
+        resp = self._inner.chat.completions.create(**kwargs)
+        usage = {
+            "prompt_tokens": getattr(resp.usage, "prompt_tokens", 0) or 0,
+            "completion_tokens": getattr(resp.usage, "completion_tokens", 0) or 0,
+        }
+        _log(resp.choices[0].message.content or "", resp.choices[0].finish_reason, usage, (time.perf_counter() - t0) * 1000)
+        return resp
+
+
+class _TapTarget(upstreams.Target):
+    def client(self):
+        if self._tap is None:
+            inner = super().client()
+            with self._client_lock:
+                if self._tap is None:
+                    self._tap = _Tap(inner)
+        return self._tap
+
+    _tap: Optional[_Tap] = None
+
+
+class _Recorded:
+    """
+    Client that answers from recorded replies, in order.
+    """
+
+    def __init__(self, attempts: List[Dict[str, Any]]):
+        self._attempts = list(attempts)
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, **kwargs):
+        if not self._attempts:
+            raise RuntimeError("no recorded reply left for this request")
+        a = self._attempts.pop(0)
+        usage = a.get("usage") or {}
+        _job.recorded_ms += a.get("latency_ms", 0.0)
+        _log(a.get("text", ""), a.get("finish_reason"), usage, a.get("latency_ms", 0.0))
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=a.get("text", "")), finish_reason=a.get("finish_reason"))],
+            usage=SimpleNamespace(prompt_tokens=usage.get("prompt_tokens", 0), completion_tokens=usage.get("completion_tokens", 0)),
+        )
+
+
+def _recorded_target(name: str, model: Optional[str], attempts: List[Dict[str, Any]]) -> upstreams.Target:
+    t = upstreams.Target(name, "recorded", model=model)
+    t._client = _Recorded(attempts)
+    return t
+
+
+def live_pool(cfg: Dict[str, Any], api) -> upstreams.Pool:
+    key = cfg.get("api_key") or os.getenv(cfg.get("api_key_env", ""), "")
+    if cfg.get("base_url") or key:
+        specs = [SimpleNamespace(name=cfg["name"], api_key=key or "none", base_url=cfg.get("base_url"), model=None, weight=1.0)]
+    else:
+        specs = api.upstream_pool.targets
+    if not specs:
+        raise SystemExit(f"{cfg['name']}: no upstream (set base_url/api_key, UPSTREAMS or OPENAI_API_KEY, or use --responses)")
+    targets = [_TapTarget(t.name, t.api_key, base_url=t.base_url, model=t.model, weight=t.weight, timeout=api.OPENAI_TIMEOUT) for t in specs]
+    return upstreams.Pool(targets, attempts=api.upstream_pool.attempts)
+
+
+def _response_path(directory: str, cfg: Dict[str, Any], rid: str, rep: int) -> str:
+    return os.path.join(directory, cfg["name"], rid + (f".r{rep}" if rep else "") + ".json")
+
+
+# ----------------------------
+# Running
+# ----------------------------
+def run_one(api, cfg: Dict[str, Any], rec: Dict[str, Any], rep: int, args, pool: Optional[upstreams.Pool]) -> Dict[str, Any]:
+    _job.log = []
+    _job.recorded_ms = 0.0
+    if args.responses and not args.record:
+        path = _response_path(args.responses, cfg, rec["id"], rep)
+        if rep and not os.path.exists(path):
+            path = _response_path(args.responses, cfg, rec["id"], 0)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                attempts = json.load(f)
+        except OSError:
+            return {"id": rec["id"], "rep": rep, "status": "error", "error": f"no recorded replies at {path}", "calls": []}
+        pool = upstreams.Pool([_recorded_target(cfg["name"], cfg.get("model"), attempts)], attempts=1)
+
+    row: Dict[str, Any] = {"id": rec["id"], "rep": rep}
+    t0 = time.perf_counter()
+    try:
+        out = api.run_analysis(
+            rec["image_data_url"],
+            api.normalize_lang(rec["lang"]),
+            model=cfg.get("model"),
+            system=cfg.get("system"),
+            fmt_mode=cfg.get("response_format"),
+            pool=pool,
+        )
+        row["status"] = "ok"
+        row.update({k: out["result"].get(k) for k in FIELDS})
+    except api.AnalysisFailed as e:
+        row["status"] = "schema_failed"
+        row["error"] = str(e)
+    except Exception as e:
+        row["status"] = "error"
+        row["error"] = f"{type(e).__name__}: {e}"
+    row["latency_ms"] = (time.perf_counter() - t0) * 1000 + _job.recorded_ms
+    row["calls"] = _job.log
+
+    if args.record and args.responses and row["calls"]:
+        path = _response_path(args.responses, cfg, rec["id"], rep)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(row["calls"], f, ensure_ascii=False, indent=1)
+    return row
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    s = sorted(values)
+    return round(s[min(len(s) - 1, max(0, math.ceil(p / 100 * len(s)) - 1))], 1)
+
+
+def _share(pairs: List[tuple]) -> Optional[float]:
+    return round(sum(1 for a, b in pairs if a == b) / len(pairs), 4) if pairs else None
+
+
+def summarize(cfg: Dict[str, Any], rows: List[Dict[str, Any]], baseline_rows: List[Dict[str, Any]], records) -> Dict[str, Any]:
+    ok = [r for r in rows if r["status"] == "ok"]
+    calls = [c for r in rows for c in r["calls"]]
+    malformed = sum(max(0, len(r["calls"]) - 1) for r in ok) + sum(len(r["calls"]) for r in rows if r["status"] == "schema_failed")
+    tok_in = sum((c.get("usage") or {}).get("prompt_tokens", 0) for c in calls)
+    tok_out = sum((c.get("usage") or {}).get("completion_tokens", 0) for c in calls)
+    lat = [r["latency_ms"] for r in rows if r["status"] != "error"]
+
+    out: Dict[str, Any] = {
+        "config": cfg["name"],
+        "model": cfg.get("model"),
+        "baseline": bool(cfg.get("baseline")),
+        "runs": len(rows),
+        "ok": len(ok),
+        "schema_failed": sum(1 for r in rows if r["status"] == "schema_failed"),
+        "errors": sum(1 for r in rows if r["status"] == "error"),
+        "latency_ms": {"p50": percentile(lat, 50), "p90": percentile(lat, 90), "p99": percentile(lat, 99)},
+        "upstream_calls": len(calls),
+        "schema_failure_rate": round(malformed / len(calls), 4) if calls else None,
+        "prompt_tokens_per_run": round(tok_in / len(rows), 1) if rows else None,
+        "completion_tokens_per_run": round(tok_out / len(rows), 1) if rows else None,
+    }
+    if cfg.get("usd_per_mtok_in") is not None or cfg.get("usd_per_mtok_out") is not None:
+        usd = tok_in * cfg.get("usd_per_mtok_in", 0) / 1e6 + tok_out * cfg.get("usd_per_mtok_out", 0) / 1e6
+        out["usd_per_1k_runs"] = round(usd / len(rows) * 1000, 4) if rows else None
+
+    # Against the baseline, run by run (same record, same repeat).
+    base = {(r["id"], r["rep"]): r for r in baseline_rows if r["status"] == "ok"}
+    both = [(r, base[(r["id"], r["rep"])]) for r in ok if (r["id"], r["rep"]) in base]
+    out["vs_baseline"] = {f: _share([(r.get(f), b.get(f)) for r, b in both]) for f in FIELDS}
+    out["vs_baseline"]["compared"] = len(both)
+    out["vs_baseline"]["risk_lower"] = sum(
+        1 for r, b in both if RISK_RANK.get(r.get("risk"), 0) < RISK_RANK.get(b.get("risk"), 0)
+    )
+
+    labelled = [(r, records[r["id"]]["expected"]) for r in ok if records[r["id"]]["expected"]]
+    if labelled:
+        out["vs_labels"] = {f: _share([(r.get(f), e.get(f)) for r, e in labelled if f in e]) for f in FIELDS}
+        out["vs_labels"]["compared"] = len(labelled)
+
+    by_id: Dict[str, set] = {}
+    for r in ok:
+        by_id.setdefault(r["id"], set()).add(r.get("verdict"))
+    repeated = [v for rid, v in by_id.items() if sum(1 for r in ok if r["id"] == rid) > 1]
+    if repeated:
+        out["verdict_stability"] = round(sum(1 for v in repeated if len(v) == 1) / len(repeated), 4)
+    return out
+
+
+def recommend(summaries: List[Dict[str, Any]], min_agreement: float) -> Optional[str]:
+    """
+    Cheapest (by cost, else tokens), then fastest p50, among configs that agree
+    with the baseline on verdict and risk at least `min_agreement` of the time,
+    never call risk lower more often than 1 - min_agreement, and don't fail the
+    schema more than the baseline does.
+    """
+    base = next(s for s in summaries if s["baseline"])
+    eligible = []
+    for s in summaries:
+        vb = s["vs_baseline"]
+        if s["baseline"]:
+            eligible.append(s)
+            continue
+        if not vb["compared"] or s["ok"] < base["ok"]:
+            continue
+        if (vb["verdict"] or 0) < min_agreement or (vb["risk"] or 0) < min_agreement:
+            continue
+        if vb["risk_lower"] > (1 - min_agreement) * vb["compared"]:
+            continue
+        if (s["schema_failure_rate"] or 0) > (base["schema_failure_rate"] or 0):
+            continue
+        eligible.append(s)
+
+    def cost(s):
+        if "usd_per_1k_runs" in s:
+            return s["usd_per_1k_runs"]
+        return (s["prompt_tokens_per_run"] or 0) + (s["completion_tokens_per_run"] or 0)
+
+    best = min(eligible, key=lambda s: (round(cost(s), 6), s["latency_ms"]["p50"] or float("inf")))
+    return best["config"]
+
+
+def print_table(summaries: List[Dict[str, Any]]) -> None:
+    cols = ["config", "ok", "p50", "p90", "p99", "tok_in", "tok_out", "$/1k", "schema_fail", "verdict", "risk", "scenario", "risk_lower"]
+    rows = []
+    for s in summaries:
+        vb = s["vs_baseline"]
+        rows.append([
+            s["config"] + (" *" if s["baseline"] else ""),
+            f"{s['ok']}/{s['runs']}",
+            s["latency_ms"]["p50"], s["latency_ms"]["p90"], s["latency_ms"]["p99"],
+            s["prompt_tokens_per_run"], s["completion_tokens_per_run"],
+            s.get("usd_per_1k_runs", "-"),
+            s["schema_failure_rate"],
+            vb["verdict"], vb["risk"], vb["scenario"], vb["risk_lower"],
+        ])
+    rows = [[("-" if v is None else str(v)) for v in r] for r in rows]
+    widths = [max(len(c), *(len(r[i]) for r in rows)) for i, c in enumerate(cols)]
+    print("  ".join(c.ljust(w) for c, w in zip(cols, widths)))
+    for r in rows:
+        print("  ".join(v.ljust(w) for v, w in zip(r, widths)))
+    print("(* baseline; verdict/risk/scenario = agreement with the baseline)")
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Replay recorded /analyze requests under several configs.")
+    ap.add_argument("records")
+    ap.add_argument("configs")
+    ap.add_argument("-j", "--concurrency", type=int, default=4, help="requests in flight at once")
+    ap.add_argument("--repeat", type=int, default=1, help="runs per record and config (verdict stability)")
+    ap.add_argument("--responses", help="directory of recorded upstream replies")
+    ap.add_argument("--record", action="store_true", help="live run that writes replies to --responses")
+    ap.add_argument("--min-agreement", type=float, default=0.95)
+    ap.add_argument("--json", help="write the full report (summaries and per-run rows) here")
+    args = ap.parse_args(argv)
+    if args.record and not args.responses:
+        ap.error("--record needs --responses DIR")
+
+    # Imported here, not at module level: it builds the app and reads the env.
+    import main as api
+
+    records = load_records(args.records)
+    configs = load_configs(args.configs)
+    if not records:
+        print(f"no records in {args.records}", file=sys.stderr)
+        return 1
+    replaying = bool(args.responses) and not args.record
+    pools = {c["name"]: (None if replaying else live_pool(c, api)) for c in configs}
+
+    jobs = [(c, r, rep) for c in configs for r in records for rep in range(args.repeat)]
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as ex:
+        results = list(ex.map(lambda j: (j[0]["name"], run_one(api, j[0], j[1], j[2], args, pools[j[0]["name"]])), jobs))
+    wall = time.perf_counter() - t0
+
+    rows: Dict[str, List[Dict[str, Any]]] = {c["name"]: [] for c in configs}
+    for name, row in results:
+        rows[name].append(row)
+    by_id = {r["id"]: r for r in records}
+    baseline = next(c for c in configs if c.get("baseline"))
+    summaries = [summarize(c, rows[c["name"]], rows[baseline["name"]], by_id) for c in configs]
+
+    print(f"{len(records)} records x {len(configs)} configs x {args.repeat} in {wall:.1f}s "
+          f"({'recorded replies' if replaying else 'live upstream'})")
+    print_table(summaries)
+    for name, rs in rows.items():
+        errs = [r for r in rs if r["status"] == "error"]
+        if errs:
+            print(f"{name}: {len(errs)} error(s), e.g. {errs[0]['id']}: {errs[0]['error']}")
+    pick = recommend(summaries, args.min_agreement)
+    print(f"suggested: {pick} (cheapest, then fastest, within {args.min_agreement:.0%} agreement of {baseline['name']})")
+
+    if args.json:
+        for rs in rows.values():
+            for r in rs:
+                r["calls"] = [{k: v for k, v in c.items() if k != "text"} for c in r["calls"]]
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"summaries": summaries, "runs": rows, "suggested": pick}, f, ensure_ascii=False, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
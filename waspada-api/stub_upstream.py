@@ -0,0 +1,196 @@
+"""
+Local OpenAI-compatible stand-in for load and failover testing (stdlib only).
+
+    python stub_upstream.py --port 8101 --rpm 30 --latency-ms 800
+    python stub_upstream.py --port 8102 --rpm 30 --fail-rate 0.2
+
+    UPSTREAMS='[{"name": "a", "api_key": "k", "base_url": "http://127.0.0.1:8101/v1"},
+                {"name": "b", "api_key": "k", "base_url": "http://127.0.0.1:8102/v1"}]'
+
+Serves /v1/chat/completions (plain and streamed, with include_usage) and
+/v1/models/<id>. Replies are the smallest JSON that satisfies the request's
+json_schema, so /analyze accepts them. --rpm is a per-key limit answered with
+429 + Retry-After, like the real thing, so you can see a pool outgrow one key.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+
+def sample(schema: Dict[str, Any], defs: Dict[str, Any]) -> Any:
+    """
+    Minimal value for a JSON schema: first enum value, empty arrays, every
+    object property filled in.
+    """
+    if "$ref" in schema:
+        return sample(defs[schema["$ref"].rsplit("/", 1)[-1]], defs)
+    if "anyOf" in schema:
+        options = [o for o in schema["anyOf"] if o.get("type") != "null"] or schema["anyOf"]
+        return sample(options[0], defs)
+    if "enum" in schema:
+        return schema["enum"][0]
+    t = schema.get("type")
+    if isinstance(t, list):
+        t = next((x for x in t if x != "null"), "null")
+    if t == "object":
+        return {k: sample(v, defs) for k, v in schema.get("properties", {}).items()}
+    if t == "array":
+        return []
+    if t == "string":
+        return "stub"
+    if t in ("integer", "number"):
+        return schema.get("minimum", 0)
+    if t == "boolean":
+        return False
+    return None
+
+
+def reply_for(body: Dict[str, Any]) -> str:
+    fmt = body.get("response_format") or {}
+    if fmt.get("type") == "json_schema":
+        schema = fmt["json_schema"]["schema"]
+        return json.dumps(sample(schema, schema.get("$defs", {})))
+    if fmt.get("type") == "json_object":
+        return "{}"
+    return "stub reply"
+
+
+class Limits:
+    def __init__(self, rpm: float):
+        self.rpm = rpm
+        self._hits: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def retry_after(self, key: str) -> Optional[float]:
+        """
+        None if the call is allowed, else seconds until it would be.
+        """
+        if not self.rpm:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            hits = [t for t in self._hits.get(key, []) if now - t < 60.0]
+            if len(hits) >= self.rpm:
+                self._hits[key] = hits
+                return max(0.1, 60.0 - (now - hits[0]))
+            hits.append(now)
+            self._hits[key] = hits
+            return None
+
+
+def make_handler(args, limits: Limits):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *a):
+            if args.verbose:
+                super().log_message(*a)
+
+        def _json(self, status: int, obj: Any, headers: Optional[Dict[str, str]] = None) -> None:
+            data = json.dumps(obj).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _key(self) -> Optional[str]:
+            auth = self.headers.get("Authorization", "")
+            return auth[7:] if auth.startswith("Bearer ") else None
+
+        def do_GET(self):
+            if not self.path.startswith("/v1/models/"):
+                return self._json(404, {"error": {"message": "not found"}})
+            self._json(200, {"id": self.path.rsplit("/", 1)[-1], "object": "model", "owned_by": "stub"})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            if self.path != "/v1/chat/completions":
+                return self._json(404, {"error": {"message": "not found"}})
+            key = self._key()
+            if not key:
+                return self._json(401, {"error": {"message": "missing API key", "type": "invalid_request_error"}})
+            wait = limits.retry_after(key)
+            if wait is not None:
+                return self._json(
+                    429,
+                    {"error": {"message": "Rate limit reached (stub)", "type": "rate_limit_error"}},
+                    {"Retry-After": str(round(wait, 1))},
+                )
+            if random.random() < args.fail_rate:
+                time.sleep(args.latency_ms / 2000.0)
+                return self._json(500, {"error": {"message": "stub failure", "type": "server_error"}})
+
+            text = reply_for(body)
+            prompt_tokens = len(json.dumps(body.get("messages", []))) // 4
+            pieces = [text[i:i + 4] for i in range(0, len(text), 4)] or [""]
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(pieces), "total_tokens": prompt_tokens + len(pieces)}
+            per_token = 1.0 / args.tokens_per_s if args.tokens_per_s else 0.0
+            model = body.get("model", "stub")
+            base = {"id": f"chatcmpl-stub-{random.getrandbits(32):x}", "created": int(time.time()), "model": model}
+            time.sleep(args.latency_ms / 1000.0)
+
+            if not body.get("stream"):
+                time.sleep(per_token * len(pieces))
+                return self._json(200, {
+                    **base,
+                    "object": "chat.completion",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                    "usage": usage,
+                })
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+
+            def event(obj):
+                self.wfile.write(b"data: " + json.dumps(obj).encode("utf-8") + b"\n\n")
+                self.wfile.flush()
+
+            try:
+                chunk = {**base, "object": "chat.completion.chunk"}
+                for p in pieces:
+                    event({**chunk, "choices": [{"index": 0, "delta": {"content": p}, "finish_reason": None}]})
+                    time.sleep(per_token)
+                event({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    event({**chunk, "choices": [], "usage": usage})
+                self.wfile.write(b"data: [DONE]\n\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # the caller hung up: exactly what cancellation should do
+
+    return Handler
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="OpenAI-compatible stand-in upstream.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8101)
+    ap.add_argument("--latency-ms", type=float, default=300.0, help="time to first token")
+    ap.add_argument("--tokens-per-s", type=float, default=200.0)
+    ap.add_argument("--rpm", type=float, default=0.0, help="requests per minute per key (0 = unlimited)")
+    ap.add_argument("--fail-rate", type=float, default=0.0, help="share of calls answered with a 500")
+    ap.add_argument("--seed", type=int)
+    ap.add_argument("-v", "--verbose", action="store_true")
+    args = ap.parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(args, Limits(args.rpm)))
+    print(f"stub upstream on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
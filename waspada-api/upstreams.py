@@ -0,0 +1,246 @@
+"""
+Pool of OpenAI-compatible upstream targets (key + base URL + model + weight).
+
+UPSTREAMS is a JSON list, e.g.
+
+    [{"name": "key-a", "api_key_env": "OPENAI_KEY_A", "weight": 2},
+     {"name": "key-b", "api_key_env": "OPENAI_KEY_B"},
+     {"name": "azure", "api_key_env": "AZURE_KEY", "base_url": "https://.../openai/v1", "model": "gpt-4o-mini"}]
+
+(`api_key` inline works too, for local stand-ins). Without it the pool is the
+single OPENAI_API_KEY / OPENAI_BASE_URL target we always had.
+
+Picking: among targets that aren't ejected, the lowest
+ewma_latency x (outstanding + 1) / weight. Unmeasured targets go first so
+every target gets a latency sample. A connection error, timeout, 429, 5xx or
+auth error moves the call to another target (up to `attempts`) and counts
+against the target; `eject_after` failures in a row eject it for
+`base_eject_s`, doubling on each repeat up to `max_eject_s`. A 429 with
+Retry-After ejects for that long straight away. Once the time is up, the
+target gets traffic again, and one success clears its record. If every
+target is ejected, the one due back soonest is used anyway.
+"""
+import json
+import os
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+from urllib.parse import urlsplit
+
+T = TypeVar("T")
+
+# Alpha for the latency moving average; ~the last 5 calls dominate.
+EWMA_ALPHA = 0.3
+
+
+class Unavailable(Exception):
+    """
+    Every target we tried failed for reasons of its own (down, rate-limited).
+    """
+
+    def __init__(self, retry_after_s: int):
+        super().__init__(f"all upstream targets unavailable; retry in {retry_after_s}s")
+        self.retry_after_s = retry_after_s
+
+
+class Target:
+    def __init__(
+        self,
+        name: str,
+        api_key: str,
+        base_url: Optional[str] = None,
+        model: Optional[str] = None,
+        weight: float = 1.0,
+        timeout: float = 45.0,
+    ):
+        self.name = name
+        self.api_key = api_key
+        self.base_url = base_url or None
+        self.model = model or None
+        self.weight = max(float(weight), 0.01)
+        self.timeout = timeout
+        self._client = None
+        self._client_lock = threading.Lock()
+
+        self.outstanding = 0
+        self.ewma_ms: Optional[float] = None
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self._backoff_level = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def client(self):
+        """
+        Built on first use: the SDK import is what a cold start can't afford.
+        Retries are the pool's job, so the SDK's own are off.
+        """
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    from openai import OpenAI
+                    self._client = OpenAI(api_key=self.api_key, base_url=self.base_url, timeout=self.timeout, max_retries=0)
+        return self._client
+
+    def stats(self, now: float) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "host": urlsplit(self.base_url).netloc if self.base_url else "api.openai.com",
+            "model": self.model,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "ewma_ms": round(self.ewma_ms, 1) if self.ewma_ms is not None else None,
+            "calls": self.calls,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "ejected_for_s": max(0, round(self.ejected_until - now, 1)),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+        }
+
+
+def retry_decision(exc: BaseException):
+    """
+    -> (retry elsewhere?, eject for N seconds or None). Errors that are about
+    the request itself (400, 413, 422, bad output) go straight to the caller.
+    """
+    import openai
+
+    if isinstance(exc, openai.APIConnectionError):  # includes timeouts
+        return True, None
+    if isinstance(exc, openai.APIStatusError):
+        status = exc.status_code
+        if status == 429:
+            try:
+                return True, float(exc.response.headers.get("retry-after", ""))
+            except ValueError:
+                return True, None
+        return status in (401, 403, 404, 408, 409) or status >= 500, None
+    return False, None
+
+
+class Pool:
+    def __init__(
+        self,
+        targets: List[Target],
+        attempts: int = 2,
+        eject_after: int = 3,
+        base_eject_s: float = 5.0,
+        max_eject_s: float = 300.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.targets = targets
+        self.attempts = max(1, attempts)
+        self.eject_after = eject_after
+        self.base_eject_s = base_eject_s
+        self.max_eject_s = max_eject_s
+        self.clock = clock
+        self._lock = threading.Lock()
+
+    def _pick(self, exclude) -> Optional[Target]:
+        now = self.clock()
+        candidates = [t for t in self.targets if t not in exclude]
+        if not candidates:
+            return None
+        healthy = [t for t in candidates if t.ejected_until <= now]
+        if not healthy:
+            return min(candidates, key=lambda t: t.ejected_until)
+        fresh = [t for t in healthy if t.ewma_ms is None]
+        if fresh:
+            return min(fresh, key=lambda t: t.outstanding / t.weight)
+        best = min(t.ewma_ms * (t.outstanding + 1) / t.weight for t in healthy)
+        return random.choice([t for t in healthy if t.ewma_ms * (t.outstanding + 1) / t.weight <= best * 1.05])
+
+    def call(self, fn: Callable[[Target], T]) -> T:
+        """
+        Run fn(target) on the best target, moving to another on failures that
+        are the target's fault.
+        """
+        tried: List[Target] = []
+        while True:
+            with self._lock:
+                target = self._pick(tried)
+                if target is None:
+                    raise RuntimeError("no upstream targets configured")
+                target.outstanding += 1
+            tried.append(target)
+            t0 = time.perf_counter()
+            try:
+                result = fn(target)
+            except BaseException as e:
+                retry, eject_s = retry_decision(e) if isinstance(e, Exception) else (False, None)
+                with self._lock:
+                    target.outstanding -= 1
+                    if retry:
+                        self._failed(target, eject_s)
+                if not retry:
+                    raise
+                if len(tried) >= min(self.attempts, len(self.targets)):
+                    raise Unavailable(self._retry_after()) from e
+                continue
+            ms = (time.perf_counter() - t0) * 1000
+            with self._lock:
+                target.outstanding -= 1
+                target.calls += 1
+                target.ewma_ms = ms if target.ewma_ms is None else target.ewma_ms + EWMA_ALPHA * (ms - target.ewma_ms)
+                target.consecutive_failures = 0
+                target._backoff_level = 0
+            return result
+
+    def _failed(self, target: Target, eject_s: Optional[float]) -> None:
+        target.calls += 1
+        target.failures += 1
+        target.consecutive_failures += 1
+        if eject_s is None and target.consecutive_failures < self.eject_after:
+            return
+        if eject_s is None:
+            eject_s = min(self.max_eject_s, self.base_eject_s * 2 ** target._backoff_level)
+            target._backoff_level += 1
+        target.ejected_until = self.clock() + eject_s
+        target.ejections += 1
+        target.consecutive_failures = 0
+
+    def _retry_after(self) -> int:
+        now = self.clock()
+        with self._lock:
+            soonest = min(t.ejected_until for t in self.targets)
+        return max(1, int(soonest - now + 0.999))
+
+    def record_tokens(self, target: Target, prompt_tokens: int, completion_tokens: int) -> None:
+        with self._lock:
+            target.prompt_tokens += prompt_tokens
+            target.completion_tokens += completion_tokens
+
+    def stats(self) -> List[Dict[str, Any]]:
+        now = self.clock()
+        with self._lock:
+            return [t.stats(now) for t in self.targets]
+
+
+def targets_from_env(timeout: float) -> List[Target]:
+    raw = os.getenv("UPSTREAMS", "").strip()
+    if not raw:
+        key = os.getenv("OPENAI_API_KEY", "")
+        if not key:
+            return []
+        return [Target("default", key, base_url=os.getenv("OPENAI_BASE_URL"), timeout=timeout)]
+    targets = []
+    for i, spec in enumerate(json.loads(raw)):
+        key = spec.get("api_key") or os.getenv(spec.get("api_key_env", ""), "")
+        if not key:
+            continue  # a key that isn't set in this environment
+        targets.append(
+            Target(
+                spec.get("name") or f"upstream-{i}",
+                key,
+                base_url=spec.get("base_url"),
+                model=spec.get("model"),
+                weight=spec.get("weight", 1.0),
+                timeout=float(spec.get("timeout", timeout)),
+            )
+        )
+    return targets